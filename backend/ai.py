@@ -0,0 +1,129 @@
+"""Prompt construction and calls to the Gemini model."""
+import hashlib
+import os
+import time
+from typing import Any, AsyncIterator, Callable, Optional
+
+from metrics import Counter, Gauge, Histogram
+from resilience import ResilientCaller
+from singleflight import SingleFlight
+
+GEMINI_BUCKETS = (0.25, 0.5, 1.0, 2.5, 5.0, 7.5, 10.0, 15.0, 20.0, 30.0, 60.0)
+GEMINI_DURATION = Histogram(
+    "nutracia_gemini_request_duration_seconds", "Gemini call latency by operation", buckets=GEMINI_BUCKETS
+)
+GEMINI_FIRST_CHUNK = Histogram(
+    "nutracia_gemini_time_to_first_chunk_seconds", "Time until a streamed Gemini response yields text", buckets=GEMINI_BUCKETS
+)
+GEMINI_ERRORS = Counter("nutracia_gemini_errors_total", "Gemini calls that raised, by operation")
+GEMINI_IN_FLIGHT = Gauge("nutracia_gemini_requests_in_flight", "Gemini calls currently in progress")
+GEMINI_TOKENS = Counter("nutracia_gemini_tokens_total", "Gemini token usage by operation and kind (prompt/completion)")
+
+
+def record_usage(operation: str, usage) -> None:
+    if usage is None:
+        return
+    GEMINI_TOKENS.inc(getattr(usage, "prompt_token_count", 0) or 0, operation=operation, kind="prompt")
+    GEMINI_TOKENS.inc(getattr(usage, "candidates_token_count", 0) or 0, operation=operation, kind="completion")
+
+
+def build_prompt(user: dict, message: str, conversation: str = "", with_name: bool = True) -> str:
+    """``with_name=False`` for prompts whose answer is shared through the response
+    cache: its key does not cover the name, so the answer must not contain it."""
+    if conversation:
+        conversation = f"Conversation so far:\n{conversation}\n\n"
+    name = f"- Name: {user.get('name', 'User')}\n        " if with_name else ""
+    return f"""
+        You are Nutracía, an intelligent medical-grade AI wellness companion.
+        You provide evidence-based guidance on nutrition, skincare, and fitness.
+
+        User Context:
+        {name}- Age: {user.get('age', 'Not specified')}
+        - Health Goals: {', '.join(user.get('health_goals', []))}
+        - Dietary Preferences: {', '.join(user.get('dietary_preferences', []))}
+        - Fitness Level: {user.get('fitness_level', 'Not specified')}
+
+        Always provide professional, evidence-based advice. If the question is outside your scope or requires medical diagnosis, recommend consulting a healthcare professional.
+
+        {conversation}User Question: {message}
+        """
+
+
+class GeminiClient:
+    """Async access to a ``genai.GenerativeModel``.
+
+    Uses the model's ``*_async`` methods so a long generation never blocks the
+    event loop. Concurrent ``generate`` calls with the same prompt share one
+    upstream request. With a ``ResilientCaller`` every call gets its deadline,
+    hedging and circuit breaker, and may raise ``UpstreamTimeout`` or
+    ``CircuitOpen``.
+
+    The model comes from ``model_factory`` on first use, in the process that
+    uses it, so no gRPC channel is opened before the server forks workers.
+    """
+
+    def __init__(self, model_factory: Callable[[], Any], caller: Optional[ResilientCaller] = None):
+        self.model_factory = model_factory
+        self.caller = caller
+        self._model = None
+        self._pid: Optional[int] = None
+        self._flight = SingleFlight("gemini_generate")
+
+    @property
+    def model(self):
+        if self._model is None or self._pid != os.getpid():
+            self._model = self.model_factory()
+            self._pid = os.getpid()
+        return self._model
+
+    async def generate(self, prompt: str) -> str:
+        key = hashlib.sha256(prompt.encode("utf-8")).digest()
+        if self.caller is None:
+            return await self._flight.do(key, lambda: self._generate(prompt))
+        return await self._flight.do(key, lambda: self.caller.call(lambda: self._generate(prompt)))
+
+    async def _generate(self, prompt: str) -> str:
+        GEMINI_IN_FLIGHT.inc(operation="generate")
+        started = time.perf_counter()
+        try:
+            response = await self.model.generate_content_async(prompt)
+            text = response.text
+        except Exception:
+            GEMINI_ERRORS.inc(operation="generate")
+            raise
+        finally:
+            GEMINI_IN_FLIGHT.dec(operation="generate")
+            GEMINI_DURATION.observe(time.perf_counter() - started, operation="generate")
+        record_usage("generate", getattr(response, "usage_metadata", None))
+        return text
+
+    async def stream(self, prompt: str) -> AsyncIterator[str]:
+        GEMINI_IN_FLIGHT.inc(operation="stream")
+        started = time.perf_counter()
+        first = True
+        usage = None
+        try:
+            if self.caller is None:
+                response = await self.model.generate_content_async(prompt, stream=True)
+            else:
+                response = self.caller.stream(lambda: self.model.generate_content_async(prompt, stream=True))
+            async for chunk in response:
+                # Usage arrives with the final chunk
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # chunks carrying only finish/safety metadata have no text parts
+                    continue
+                if text:
+                    if first:
+                        GEMINI_FIRST_CHUNK.observe(time.perf_counter() - started)
+                        first = False
+                    yield text
+        except Exception:
+            GEMINI_ERRORS.inc(operation="stream")
+            raise
+        finally:
+            GEMINI_IN_FLIGHT.dec(operation="stream")
+            GEMINI_DURATION.observe(time.perf_counter() - started, operation="stream")
+            record_usage("stream", usage)
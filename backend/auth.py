@@ -0,0 +1,157 @@
+"""JWT issuing and verification with a verified-token cache and revocation.
+
+Verifying a token's signature on every request is the expensive part of
+authentication, so verified claims are cached under a hash of the token
+until the token expires; after that a request costs a dictionary lookup and
+a revocation check. Revocations live in MongoDB so every worker sees them:
+``revoked_tokens`` holds single logged-out tokens and ``session_revocations``
+a per-user cutoff that invalidates every token issued before it. Each worker
+mirrors both in memory and refreshes the mirror every ``sync_interval``
+seconds; revocations made by a worker apply there immediately.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from jose import JWTError, jwt
+
+from metrics import Counter
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+TOKEN_CACHE_REQUESTS = Counter("nutracia_auth_token_cache_requests_total", "Verified-token cache lookups by result")
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def token_id(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class TokenAuthenticator:
+    def __init__(
+        self,
+        db,
+        secret_key: str,
+        algorithm: str,
+        token_ttl: timedelta = timedelta(hours=24),
+        cache_size: int = 10000,
+        sync_interval: float = 10,
+    ):
+        self.revoked_tokens = db.revoked_tokens
+        self.session_revocations = db.session_revocations
+        self.secret_key = secret_key
+        self.algorithm = algorithm
+        self.token_ttl = token_ttl
+        self.sync_interval = sync_interval
+        self._verified = TTLCache(maxsize=cache_size, ttl=token_ttl.total_seconds())
+        # token id -> exp, and user id -> cutoff (epoch seconds)
+        self._revoked: Dict[str, float] = {}
+        self._revoked_before: Dict[str, float] = {}
+        self._last_sync: Optional[datetime] = None
+
+    def create_access_token(self, user_id: str) -> str:
+        now = time.time()
+        claims = {
+            "sub": user_id,
+            # Sub-second precision so a login right after "revoke all" is not caught by the cutoff
+            "iat": now,
+            "exp": datetime.utcnow() + self.token_ttl,
+        }
+        return jwt.encode(claims, self.secret_key, algorithm=self.algorithm)
+
+    def verify(self, token: str) -> dict:
+        """Claims of a valid, unexpired, unrevoked token; raises InvalidToken otherwise."""
+        tid = token_id(token)
+        claims = self._verified.get(tid)
+        if claims is None:
+            TOKEN_CACHE_REQUESTS.inc(result="miss")
+            try:
+                claims = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
+            except JWTError:
+                raise InvalidToken()
+            if claims.get("sub") is None or "exp" not in claims:
+                raise InvalidToken()
+            claims["tid"] = tid
+            # Never cache past the token's own expiry
+            self._verified.set(tid, claims, ttl=claims["exp"] - time.time())
+        else:
+            TOKEN_CACHE_REQUESTS.inc(result="hit")
+            if claims["exp"] <= time.time():
+                self._verified.pop(tid)
+                raise InvalidToken()
+
+        if tid in self._revoked or claims.get("iat", 0) < self._revoked_before.get(claims["sub"], 0):
+            raise InvalidToken()
+        return claims
+
+    async def revoke(self, claims: dict) -> None:
+        """Revoke one token (logout)."""
+        self._revoked[claims["tid"]] = claims["exp"]
+        await self.revoked_tokens.replace_one(
+            {"_id": claims["tid"]},
+            {
+                "user_id": claims["sub"],
+                "expires_at": datetime.utcfromtimestamp(claims["exp"]),
+                "created_at": datetime.utcnow(),
+            },
+            upsert=True,
+        )
+
+    async def revoke_all(self, user_id: str) -> None:
+        """Revoke every token issued to ``user_id`` so far."""
+        now = datetime.utcnow()
+        self._revoked_before[user_id] = time.time()
+        await self.session_revocations.replace_one(
+            {"_id": user_id},
+            {
+                "revoked_before": self._revoked_before[user_id],
+                "updated_at": now,
+                # Tokens issued before the cutoff are all expired by then
+                "expires_at": now + self.token_ttl,
+            },
+            upsert=True,
+        )
+
+    async def sync(self) -> None:
+        """Pull revocations made by other workers since the last sync."""
+        started = datetime.utcnow()
+        tokens_query, sessions_query = {}, {}
+        if self._last_sync is not None:
+            # Overlap the previous window to tolerate clock skew between workers
+            since = self._last_sync - timedelta(seconds=self.sync_interval + 60)
+            tokens_query = {"created_at": {"$gte": since}}
+            sessions_query = {"updated_at": {"$gte": since}}
+        async for doc in self.revoked_tokens.find(tokens_query, {"expires_at": 1}):
+            self._revoked[doc["_id"]] = (doc["expires_at"] - datetime(1970, 1, 1)).total_seconds()
+        async for doc in self.session_revocations.find(sessions_query, {"revoked_before": 1}):
+            cutoff = doc["revoked_before"]
+            if cutoff > self._revoked_before.get(doc["_id"], 0):
+                self._revoked_before[doc["_id"]] = cutoff
+        self._last_sync = started
+        self._prune()
+
+    def _prune(self) -> None:
+        now = time.time()
+        for tid in [tid for tid, exp in self._revoked.items() if exp <= now]:
+            del self._revoked[tid]
+        horizon = now - self.token_ttl.total_seconds()
+        for user_id in [u for u, cutoff in self._revoked_before.items() if cutoff <= horizon]:
+            del self._revoked_before[user_id]
+
+    async def run_sync(self) -> None:
+        """Keep the in-memory revocations current; call ``sync`` once before starting this."""
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Revocation sync failed")
@@ -0,0 +1,317 @@
+"""Time-bucketed chat history with TTL retention and archival compaction.
+
+``BucketedChatHistoryRepository`` is a drop-in for ``ChatHistoryRepository``.
+Each message is pushed onto the user's bucket for its UTC day in
+``chat_buckets``. That gives one document per user per day instead of one per
+message. A bucket takes at most ``max_per_bucket`` messages, after which the
+next write opens a second bucket for the same day. Buckets carry an
+``expires_at`` of ``ttl_days`` after their day, so hot data ages out even if
+nothing archives it.
+
+``ChatCompactor`` moves buckets older than ``archive_after_days`` into
+``chat_archive`` as one zlib-compressed BSON blob each. It drains the old
+per-message ``chat_history`` collection the same way, so switching storage
+mode keeps earlier history readable. Reads merge all three sources day by
+day, newest first, and de-duplicate on the message ``_id``. A compaction that
+runs while a page is read never shows a message twice, and never hides one.
+"""
+import asyncio
+import logging
+import zlib
+from datetime import datetime, timedelta
+from typing import AsyncIterator, List, Optional, Tuple
+
+import bson
+from bson import Binary, ObjectId
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+COMPACTED_MESSAGES = Counter(
+    "nutracia_chat_compacted_messages_total", "Chat messages moved into chat_archive, by source collection"
+)
+
+
+def _day_start(at: datetime) -> datetime:
+    return datetime(at.year, at.month, at.day)
+
+
+def _project(message: dict, projection: Optional[dict]) -> dict:
+    """Apply a find()-style projection to a message held in a bucket."""
+    if not projection:
+        return message
+    included = {k for k, v in projection.items() if v and k != "_id"}
+    if included:
+        if projection.get("_id", 1):
+            included.add("_id")
+        return {k: v for k, v in message.items() if k in included}
+    return {k: v for k, v in message.items() if projection.get(k, 1)}
+
+
+class BucketedChatHistoryRepository:
+    def __init__(
+        self,
+        db,
+        max_per_bucket: int = 200,
+        ttl_days: int = 0,
+        compression_level: int = 6,
+        read_batch_size: int = 4,
+    ):
+        """``ttl_days`` of 0 keeps hot buckets until the compactor archives them."""
+        self.collection = db.chat_buckets
+        self.archive = db.chat_archive
+        self.legacy = db.chat_history
+        self.max_per_bucket = max_per_bucket
+        self.ttl = timedelta(days=ttl_days) if ttl_days > 0 else None
+        self.compression_level = compression_level
+        # Buckets are large; fetch a few per round trip rather than the driver's default 101
+        self.read_batch_size = read_batch_size
+
+    async def add(self, chat_record: dict) -> None:
+        chat_record.setdefault("_id", ObjectId())
+        message = {k: v for k, v in chat_record.items() if k != "user_id"}
+        day = _day_start(chat_record["timestamp"])
+        update = {"$push": {"messages": message}, "$inc": {"count": 1}}
+        if self.ttl is not None:
+            update["$setOnInsert"] = {"expires_at": day + self.ttl}
+        # A full bucket no longer matches, so the upsert starts the day's next one
+        await self.collection.update_one(
+            {"user_id": chat_record["user_id"], "day": day, "count": {"$lt": self.max_per_bucket}},
+            update,
+            upsert=True,
+        )
+
+    async def count(self, user_id: str) -> int:
+        total = 0
+        for collection in (self.collection, self.archive):
+            pipeline = [{"$match": {"user_id": user_id}}, {"$group": {"_id": None, "count": {"$sum": "$count"}}}]
+            result = await collection.aggregate(pipeline).to_list(length=1)
+            total += result[0]["count"] if result else 0
+        return total + await self.legacy.count_documents({"user_id": user_id})
+
+    async def recent(self, user_id: str, limit: int, projection: Optional[dict] = None) -> List[dict]:
+        chats = []
+        async for chat in self.iterate(user_id):
+            chats.append(_project(chat, projection))
+            if len(chats) >= limit:
+                break
+        return chats
+
+    async def page(
+        self,
+        user_id: str,
+        limit: int,
+        before: Optional[Tuple[datetime, ObjectId]] = None,
+        preview_chars: Optional[int] = None,
+    ) -> List[dict]:
+        """Same contract as ``ChatHistoryRepository.page``; the answer is cut down here, not in MongoDB."""
+        chats = []
+        async for chat in self.iterate(user_id, before=before):
+            if preview_chars is not None:
+                answer = chat.get("ai_response") or ""
+                chat = {**chat, "ai_response": answer[:preview_chars], "truncated": len(answer) > preview_chars}
+            chats.append(chat)
+            if len(chats) >= limit:
+                break
+        return chats
+
+    async def get(self, user_id: str, chat_id: ObjectId) -> Optional[dict]:
+        # The id was minted when the message was stored, so it pins the bucket's day
+        day = _day_start(chat_id.generation_time.replace(tzinfo=None))
+        days = {"$gte": day - timedelta(days=1), "$lte": day + timedelta(days=1)}
+        bucket = await self.collection.find_one(
+            {"user_id": user_id, "day": days, "messages._id": chat_id},
+            {"messages": {"$elemMatch": {"_id": chat_id}}},
+        )
+        if bucket and bucket.get("messages"):
+            return {**bucket["messages"][0], "user_id": user_id}
+        archived = await self.archive.find_one({"ids": chat_id, "user_id": user_id})
+        if archived:
+            for message in self.unpack(archived):
+                if message["_id"] == chat_id:
+                    return {**message, "user_id": user_id}
+        return await self.legacy.find_one({"_id": chat_id, "user_id": user_id})
+
+    async def iterate(
+        self,
+        user_id: str,
+        before: Optional[Tuple[datetime, ObjectId]] = None,
+        since: Optional[datetime] = None,
+        oldest_first: bool = False,
+        batch_size: Optional[int] = None,
+    ) -> AsyncIterator[dict]:
+        """Every chat of ``user_id`` strictly older than ``before`` (timestamp, _id) and newer than ``since``.
+
+        Newest first unless ``oldest_first``. At most one day of messages per
+        source is held in memory; ``batch_size`` counts bucket documents.
+        """
+        batch_size = batch_size or self.read_batch_size
+        day_query = {"user_id": user_id}
+        legacy_query = {"user_id": user_id}
+        days, timestamps = {}, {}
+        if before is not None:
+            days["$lte"] = _day_start(before[0])
+            timestamps["$lt"] = days["$lte"] + timedelta(days=1)
+        if since is not None:
+            days["$gte"] = _day_start(since)
+            timestamps["$gt"] = since
+        if days:
+            day_query["day"] = days
+            legacy_query["timestamp"] = timestamps
+        order = 1 if oldest_first else -1
+        sources = [
+            self._group_by_day(
+                self.collection.find(day_query).sort("day", order).batch_size(batch_size),
+                lambda doc: doc["day"],
+                lambda doc: doc["messages"],
+            ),
+            self._group_by_day(
+                self.archive.find(day_query).sort("day", order).batch_size(batch_size),
+                lambda doc: doc["day"],
+                self.unpack,
+            ),
+            self._group_by_day(
+                self.legacy.find(legacy_query, {"user_id": 0}).sort([("timestamp", order), ("_id", order)]),
+                lambda doc: _day_start(doc["timestamp"]),
+                lambda doc: [doc],
+            ),
+        ]
+        try:
+            async for messages in self._merge(sources, oldest_first):
+                for message in messages:
+                    if before is not None and (message["timestamp"], message["_id"]) >= before:
+                        continue
+                    if since is not None and message["timestamp"] <= since:
+                        continue
+                    yield {**message, "user_id": user_id}
+        finally:
+            for source in sources:
+                await source.aclose()
+
+    def pack(self, user_id: str, day: datetime, messages: List[dict]) -> dict:
+        """An archive document holding ``messages`` compressed."""
+        blob = zlib.compress(bson.encode({"messages": messages}), self.compression_level)
+        return {
+            "user_id": user_id,
+            "day": day,
+            "count": len(messages),
+            # Uncompressed so a single archived message can be found by id
+            "ids": [m["_id"] for m in messages],
+            "first_at": min(m["timestamp"] for m in messages),
+            "last_at": max(m["timestamp"] for m in messages),
+            "codec": "zlib+bson",
+            "data": Binary(blob),
+        }
+
+    @staticmethod
+    def unpack(archived: dict) -> List[dict]:
+        return bson.decode(zlib.decompress(archived["data"]))["messages"]
+
+    @staticmethod
+    async def _group_by_day(cursor, day_of, messages_of) -> AsyncIterator[Tuple[datetime, List[dict]]]:
+        day, messages = None, []
+        async for doc in cursor:
+            doc_day = day_of(doc)
+            if doc_day != day and messages:
+                yield day, messages
+                messages = []
+            day = doc_day
+            messages.extend(messages_of(doc))
+        if messages:
+            yield day, messages
+
+    @staticmethod
+    async def _merge(sources, oldest_first: bool = False) -> AsyncIterator[List[dict]]:
+        """Combine sources sorted by day into one list per day, in the same order."""
+        pick = min if oldest_first else max
+        heads = [await anext(source, None) for source in sources]
+        while any(heads):
+            day = pick(head[0] for head in heads if head)
+            seen, merged = set(), []
+            for i, head in enumerate(heads):
+                if head and head[0] == day:
+                    for message in head[1]:
+                        if message["_id"] not in seen:
+                            seen.add(message["_id"])
+                            merged.append(message)
+                    heads[i] = await anext(sources[i], None)
+            merged.sort(key=lambda m: (m["timestamp"], m["_id"]), reverse=not oldest_first)
+            yield merged
+
+
+class ChatCompactor:
+    """Moves old buckets, and any per-message ``chat_history`` documents, into ``chat_archive``.
+
+    Each step writes the archive document before deleting its source, and
+    archive ids are derived from the source, so a step interrupted halfway is
+    simply redone. Several workers running the compactor at once only repeat
+    each other's work.
+    """
+
+    def __init__(
+        self,
+        repository: BucketedChatHistoryRepository,
+        archive_after_days: int = 30,
+        interval: float = 3600,
+        batch_size: int = 100,
+    ):
+        if repository.ttl is not None and timedelta(days=archive_after_days) >= repository.ttl:
+            raise ValueError("archive_after_days must be shorter than the bucket TTL, or buckets expire unarchived")
+        self.repository = repository
+        self.archive_after = timedelta(days=archive_after_days)
+        self.interval = interval
+        self.batch_size = batch_size
+
+    async def compact_buckets(self) -> int:
+        """Archive one batch of buckets older than the cutoff; returns how many were moved."""
+        repo = self.repository
+        cutoff = _day_start(datetime.utcnow()) - self.archive_after
+        cursor = repo.collection.find({"day": {"$lt": cutoff}}).sort("day", 1).limit(self.batch_size)
+        moved = 0
+        async for bucket in cursor.batch_size(repo.read_batch_size):
+            archived = repo.pack(bucket["user_id"], bucket["day"], bucket["messages"])
+            await repo.archive.replace_one({"_id": bucket["_id"]}, archived, upsert=True)
+            # Only if nothing was pushed since it was read; otherwise the next pass redoes it
+            await repo.collection.delete_one({"_id": bucket["_id"], "count": bucket["count"]})
+            COMPACTED_MESSAGES.inc(len(bucket["messages"]), source="chat_buckets")
+            moved += 1
+        return moved
+
+    async def drain_legacy(self) -> int:
+        """Archive one batch of per-message chat_history documents older than the cutoff; returns how many were moved.
+
+        Newer ones stay where they are, so recent history is never read out of a
+        compressed archive; later passes pick them up once they age.
+        """
+        repo = self.repository
+        # The _id is minted when the chat is stored, so it dates the document and the scan stays on the _id index
+        cutoff = ObjectId.from_datetime(_day_start(datetime.utcnow()) - self.archive_after)
+        docs = await repo.legacy.find({"_id": {"$lt": cutoff}}).sort("_id", 1).to_list(length=self.batch_size)
+        groups = {}
+        for doc in docs:
+            user_id = doc.pop("user_id")
+            groups.setdefault((user_id, _day_start(doc["timestamp"])), []).append(doc)
+        for (user_id, day), messages in groups.items():
+            archived = repo.pack(user_id, day, messages)
+            await repo.archive.replace_one({"_id": messages[0]["_id"]}, archived, upsert=True)
+            await repo.legacy.delete_many({"_id": {"$in": [m["_id"] for m in messages]}})
+            COMPACTED_MESSAGES.inc(len(messages), source="chat_history")
+        return len(docs)
+
+    async def compact(self) -> None:
+        """Run batches until both sources have nothing left to move."""
+        while await self.compact_buckets() >= self.batch_size:
+            await asyncio.sleep(0)
+        while await self.drain_legacy() >= self.batch_size:
+            await asyncio.sleep(0)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.compact()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Chat history compaction failed")
+            await asyncio.sleep(self.interval)
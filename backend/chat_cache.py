@@ -0,0 +1,107 @@
+"""Cache of AI chat answers keyed on the question and the profile fields in the prompt.
+
+Two tiers: a per-process LRU/TTL cache answers in microseconds, and an
+optional MongoDB collection lets workers share answers. Keys combine a
+normalized form of the question with a fingerprint of the profile fields
+that ``build_prompt`` renders, so users with the same profile share entries.
+"""
+import hashlib
+import json
+import re
+import unicodedata
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from metrics import Counter
+from ttl_cache import TTLCache
+
+# Profile fields that shape the answer; a change to any of them changes the key.
+# The name is left out of both the key and every prompt whose answer is cached.
+FINGERPRINT_FIELDS = ("age", "health_goals", "dietary_preferences", "fitness_level")
+
+CACHE_REQUESTS = Counter(
+    "nutracia_chat_cache_requests_total", "AI chat response cache lookups by tier and result"
+)
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    text = unicodedata.normalize("NFKC", question).casefold()
+    text = _WHITESPACE.sub(" ", text).strip()
+    return text.rstrip("?!. ")
+
+
+def profile_fingerprint(user: dict, fields: Tuple[str, ...] = FINGERPRINT_FIELDS) -> str:
+    profile = {}
+    for field in fields:
+        value = user.get(field)
+        if isinstance(value, list):
+            value = sorted(str(v).strip().casefold() for v in value)
+        elif isinstance(value, str):
+            value = value.strip().casefold()
+        profile[field] = value or None
+    encoded = json.dumps(profile, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:32]
+
+
+class ResponseCache:
+    def __init__(self, db=None, maxsize: int = 1024, ttl: int = 3600, shared_ttl: int = 86400):
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.collection = db.ai_response_cache if db is not None else None
+        self.shared_ttl = shared_ttl
+
+    @staticmethod
+    def key(question: str, fingerprint: str) -> str:
+        question_hash = hashlib.sha256(normalize_question(question).encode("utf-8")).hexdigest()[:32]
+        return f"{fingerprint}:{question_hash}"
+
+    async def get(self, question: str, fingerprint: str) -> Optional[str]:
+        key = self.key(question, fingerprint)
+        answer = self.local.get(key)
+        if answer is not None:
+            CACHE_REQUESTS.inc(tier="memory", result="hit")
+            return answer
+        CACHE_REQUESTS.inc(tier="memory", result="miss")
+
+        if self.collection is None:
+            return None
+        doc = await self.collection.find_one(
+            {"_id": key, "expires_at": {"$gt": datetime.utcnow()}}, {"response": 1}
+        )
+        if doc is None:
+            CACHE_REQUESTS.inc(tier="mongo", result="miss")
+            return None
+        CACHE_REQUESTS.inc(tier="mongo", result="hit")
+        self.local.set(key, doc["response"])
+        return doc["response"]
+
+    async def set(self, question: str, fingerprint: str, answer: str) -> None:
+        key = self.key(question, fingerprint)
+        self.local.set(key, answer)
+        if self.collection is None:
+            return
+        now = datetime.utcnow()
+        await self.collection.replace_one(
+            {"_id": key},
+            {
+                "fingerprint": fingerprint,
+                "question": normalize_question(question),
+                "response": answer,
+                "created_at": now,
+                "expires_at": now + timedelta(seconds=self.shared_ttl),
+            },
+            upsert=True,
+        )
+
+    async def invalidate(self, fingerprint: str) -> None:
+        prefix = f"{fingerprint}:"
+        self.local.discard_where(lambda key: key.startswith(prefix))
+        if self.collection is not None:
+            await self.collection.delete_many({"fingerprint": fingerprint})
+
+    async def ensure_indexes(self) -> None:
+        if self.collection is None:
+            return
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+        await self.collection.create_index("fingerprint")
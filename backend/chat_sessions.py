@@ -0,0 +1,102 @@
+"""State and limits for WebSocket chat sessions.
+
+A ``ChatSession`` holds what the HTTP chat path rebuilds on every request:
+the verified token, the user's profile and their latest conversation
+turns. Turns are appended as the session answers, so the history is read
+from MongoDB once per session. It is read again only when the cached
+profile shows a new ``profile_version`` or a rewritten memory summary.
+
+``SessionRegistry`` caps open sessions per user and per worker process, and
+separately the sockets that are still authenticating, which belong to no user yet.
+"""
+from contextlib import contextmanager
+from typing import List, Optional
+
+from metrics import Counter, Gauge
+
+WS_SESSIONS = Gauge("nutracia_websocket_sessions", "Open WebSocket chat sessions")
+WS_PENDING = Gauge("nutracia_websocket_sessions_pending", "WebSocket connections still authenticating")
+WS_REJECTED = Counter("nutracia_websocket_sessions_rejected_total", "WebSocket chat sessions refused, by limit")
+
+
+class TooManySessions(Exception):
+    def __init__(self, scope: str):
+        super().__init__(f"Too many open chat sessions ({scope})")
+        self.scope = scope
+
+
+def _summary_marker(profile: dict):
+    return (profile.get("memory") or {}).get("summarized_through")
+
+
+class ChatSession:
+    def __init__(self, user_id: str, token: str, max_turns: int):
+        self.user_id = user_id
+        self.token = token
+        self.max_turns = max_turns
+        self.profile: Optional[dict] = None
+        self.turns: List[dict] = []
+
+    def is_stale(self, profile: dict) -> bool:
+        if self.profile is None:
+            return True
+        # The profile cache hands out the same dict until the entry is replaced
+        if profile is self.profile:
+            return False
+        return (
+            profile.get("profile_version") != self.profile.get("profile_version")
+            or _summary_marker(profile) != _summary_marker(self.profile)
+        )
+
+    def load(self, profile: dict, turns: List[dict]) -> None:
+        self.profile = profile
+        self.turns = list(turns)
+
+    def add_turn(self, turn: dict) -> None:
+        self.turns.insert(0, turn)
+        del self.turns[self.max_turns:]
+
+
+class SessionRegistry:
+    def __init__(self, max_per_user: int = 3, max_total: int = 1000, max_pending: int = 100):
+        self.max_per_user = max_per_user
+        self.max_total = max_total
+        self.max_pending = max_pending
+        self._by_user = {}
+        self._total = 0
+        self._pending = 0
+
+    @contextmanager
+    def authenticating(self):
+        """Count a socket until it has authenticated; raises TooManySessions past ``max_pending``."""
+        if self._pending >= self.max_pending:
+            WS_REJECTED.inc(limit="pending")
+            raise TooManySessions("pending authentication")
+        self._pending += 1
+        WS_PENDING.set(self._pending)
+        try:
+            yield
+        finally:
+            self._pending -= 1
+            WS_PENDING.set(self._pending)
+
+    @contextmanager
+    def open(self, user_id: str):
+        """Count a session for its lifetime; raises TooManySessions at either limit."""
+        if self._total >= self.max_total:
+            WS_REJECTED.inc(limit="worker")
+            raise TooManySessions("worker")
+        if self._by_user.get(user_id, 0) >= self.max_per_user:
+            WS_REJECTED.inc(limit="user")
+            raise TooManySessions("user")
+        self._by_user[user_id] = self._by_user.get(user_id, 0) + 1
+        self._total += 1
+        WS_SESSIONS.set(self._total)
+        try:
+            yield
+        finally:
+            self._total -= 1
+            self._by_user[user_id] -= 1
+            if not self._by_user[user_id]:
+                del self._by_user[user_id]
+            WS_SESSIONS.set(self._total)
@@ -0,0 +1,50 @@
+"""Per-process MongoDB client created on first use.
+
+Creating a client at import time pays for DNS (SRV) resolution and starts
+monitor threads before uvicorn or gunicorn fork their workers, and a client
+inherited across a fork is not safe to use. ``MongoConnection`` builds the
+Motor client the first time the database is needed, in the process that
+needs it, and builds a fresh one if it finds itself in a forked child.
+"""
+import os
+from typing import Optional
+
+from motor import motor_asyncio
+
+
+class MongoConnection:
+    def __init__(self, url: str, database: str, **pool_options):
+        self.url = url
+        self.database_name = database
+        # Passed to the client as-is: maxPoolSize, minPoolSize, maxIdleTimeMS, ...
+        self.pool_options = {k: v for k, v in pool_options.items() if v is not None}
+        self._client = None
+        self._database = None
+        self._pid: Optional[int] = None
+
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            # Looked up at call time so tools that swap the driver class still take effect
+            self._client = motor_asyncio.AsyncIOMotorClient(self.url, **self.pool_options)
+            self._database = None
+            self._pid = os.getpid()
+        return self._client
+
+    @property
+    def database(self):
+        # One object per client, so collections bound to it are only rebuilt after a fork
+        client = self.client
+        if self._database is None:
+            self._database = client[self.database_name]
+        return self._database
+
+    @property
+    def connected(self) -> bool:
+        return self._client is not None and self._pid == os.getpid()
+
+    def close(self) -> None:
+        if self.connected:
+            self._client.close()
+        self._client = None
+        self._database = None
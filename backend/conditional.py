@@ -0,0 +1,41 @@
+"""ETags and conditional GETs for the endpoints the frontend polls.
+
+An ETag here is built from version counters the write paths already keep:
+the user's ``profile_version``, the cart's ``version``, the dashboard
+summary's ``revision``. So a route can answer ``If-None-Match`` after a
+projection-only read, without reading the full documents or encoding a
+body. The negotiated format (JSON or msgpack) is part of the tag, because the
+two representations differ byte for byte.
+"""
+import hashlib
+from typing import Any, Optional
+
+from starlette.responses import Response
+
+from serialization import NegotiatedResponse, negotiated_format
+
+
+def make_etag(*parts: Any) -> str:
+    raw = "|".join(str(part) for part in (*parts, negotiated_format()))
+    return f'W/"{hashlib.sha256(raw.encode("utf-8")).hexdigest()[:24]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison, as If-None-Match calls for."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in if_none_match.split(","))
+
+
+def not_modified(etag: str, cache_control: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept"})
+
+
+def tagged_response(content: Any, etag: Optional[str], cache_control: str) -> NegotiatedResponse:
+    headers = {"Cache-Control": cache_control}
+    if etag is not None:
+        headers["ETag"] = etag
+    return NegotiatedResponse(content, headers=headers)
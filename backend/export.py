@@ -0,0 +1,85 @@
+"""Streaming NDJSON export of a user's profile, cart and chat history.
+
+``export_records`` yields one JSON document per line: an ``export`` header,
+the profile, the cart, every chat oldest first, and a closing ``end`` record.
+Chats come straight off a repository cursor, so memory stays flat however
+long the history is. Each chat line carries its timestamp. To resume an
+interrupted export, pass the last one received back as ``since``. If the
+cursor fails partway, the stream ends with an ``error`` record holding that
+timestamp instead of ``end``.
+
+``gzip_stream`` compresses the stream incrementally. The gzip middleware
+cannot do this: it would hold the whole body back.
+"""
+import logging
+import zlib
+from datetime import datetime
+from typing import AsyncIterator, Optional
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+logger = logging.getLogger(__name__)
+
+
+def ndjson_line(record: dict) -> bytes:
+    return orjson.dumps(record, default=jsonable_encoder, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+
+
+async def export_records(
+    profile: dict,
+    cart: Optional[dict],
+    chats: AsyncIterator[dict],
+    since: Optional[datetime] = None,
+) -> AsyncIterator[bytes]:
+    yield ndjson_line({
+        "type": "export",
+        "user_id": profile.get("id"),
+        "generated_at": datetime.utcnow(),
+        "since": since,
+    })
+    yield ndjson_line({"type": "profile", **profile})
+    yield ndjson_line({
+        "type": "cart",
+        "items": (cart or {}).get("items", []),
+        "version": (cart or {}).get("version", 0),
+        "updated_at": (cart or {}).get("updated_at"),
+    })
+    count, last_timestamp = 0, since
+    try:
+        async for chat in chats:
+            yield ndjson_line({
+                "type": "chat",
+                "id": str(chat["_id"]),
+                "user_message": chat.get("user_message"),
+                "ai_response": chat.get("ai_response"),
+                "timestamp": chat.get("timestamp"),
+            })
+            count += 1
+            last_timestamp = chat.get("timestamp")
+    except Exception as e:
+        logger.exception("Export of %s failed after %d chats", profile.get("id"), count)
+        yield ndjson_line({"type": "error", "detail": str(e), "chats": count, "resume_since": last_timestamp})
+        return
+    yield ndjson_line({"type": "end", "chats": count, "last_timestamp": last_timestamp})
+
+
+async def coalesce(chunks: AsyncIterator[bytes], size: int = 16384) -> AsyncIterator[bytes]:
+    """Join small chunks into writes of about ``size`` bytes."""
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+async def gzip_stream(chunks: AsyncIterator[bytes], level: int = 6) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,80 @@
+"""bcrypt hashing on a bounded worker pool.
+
+bcrypt releases the GIL while it works, so a thread pool sized to the cores
+keeps hashing off the event loop without the cost of a process pool. Calls
+beyond ``max_pending`` are refused with ``HasherSaturated`` instead of
+queueing without bound behind a login storm.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import bcrypt
+
+from metrics import Counter, Gauge, Histogram
+
+HASH_QUEUE_DEPTH = Gauge(
+    "nutracia_password_hash_queue_depth", "Password hash jobs waiting for a worker thread"
+)
+HASH_IN_FLIGHT = Gauge("nutracia_password_hash_in_flight", "Password hash jobs running or queued")
+HASH_LATENCY = Histogram(
+    "nutracia_password_hash_seconds",
+    "Time from submitting a password hash job to its result",
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0, 5.0),
+)
+HASH_REJECTED = Counter(
+    "nutracia_password_hash_rejected_total", "Password hash jobs refused because the pool was saturated"
+)
+
+
+class HasherSaturated(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("Password hashing pool is saturated")
+        self.retry_after = retry_after
+
+
+def _hash(password: str) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+
+def _verify(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+class PasswordHasher:
+    def __init__(self, workers: Optional[int] = None, max_pending: Optional[int] = None, retry_after: int = 1):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 4
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        self._pending = 0
+
+    async def hash(self, password: str) -> str:
+        return await self._submit("hash", _hash, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._submit("verify", _verify, password, hashed)
+
+    async def _submit(self, op: str, fn, *args):
+        if self._pending >= self.max_pending:
+            HASH_REJECTED.inc(op=op)
+            raise HasherSaturated(self.retry_after)
+
+        self._pending += 1
+        self._update_gauges()
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+            self._update_gauges()
+            HASH_LATENCY.observe(time.perf_counter() - start, op=op)
+
+    def _update_gauges(self) -> None:
+        HASH_IN_FLIGHT.set(self._pending)
+        HASH_QUEUE_DEPTH.set(max(0, self._pending - self.workers))
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,107 @@
+"""Index bootstrap and query-plan checks for the hot collections.
+
+``ensure_indexes`` runs at startup and is idempotent. ``verify_query_plans``
+explains each hot query and raises if any of them would scan a whole
+collection, so a missing or unusable index fails the deploy rather than
+surfacing later as slow requests.
+"""
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+INDEXES = {
+    "users": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("email", ASCENDING)], unique=True, name="email_unique"),
+    ],
+    "chat_history": [
+        # Also serves the keyset pagination tie-break on _id
+        IndexModel(
+            [("user_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)],
+            name="user_id_timestamp_id",
+        ),
+    ],
+    # Bucketed chat storage (chat_buckets.py); day alone serves the compactor's scan
+    "chat_buckets": [
+        IndexModel([("user_id", ASCENDING), ("day", DESCENDING)], name="user_id_day"),
+        IndexModel([("day", ASCENDING)], name="day"),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+    ],
+    "chat_archive": [
+        IndexModel([("user_id", ASCENDING), ("day", DESCENDING)], name="user_id_day"),
+        IndexModel([("ids", ASCENDING)], name="ids"),
+    ],
+    "carts": [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+    ],
+    "dashboard_summaries": [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+    ],
+    "ai_jobs": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+    ],
+    # Revocations only matter until the tokens they cover expire
+    "revoked_tokens": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+        IndexModel([("created_at", ASCENDING)], name="created_at"),
+    ],
+    # Pending claims expire after the claim timeout, finished tips after a couple of days
+    "daily_tips": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+        IndexModel([("day", ASCENDING)], name="day"),
+    ],
+    "rate_limits": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+    ],
+    "ai_usage": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+    ],
+    "session_revocations": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at_ttl"),
+        IndexModel([("updated_at", ASCENDING)], name="updated_at"),
+    ],
+}
+
+# (collection, filter, sort) for every query on a request path
+HOT_QUERIES = [
+    ("users", {"id": "probe"}, None),
+    ("users", {"email": "probe"}, None),
+    ("chat_history", {"user_id": "probe"}, {"timestamp": -1}),
+    ("chat_history", {"user_id": "probe"}, {"timestamp": -1, "_id": -1}),
+    ("chat_buckets", {"user_id": "probe"}, {"day": -1}),
+    ("chat_archive", {"user_id": "probe"}, {"day": -1}),
+    ("carts", {"user_id": "probe"}, None),
+    ("dashboard_summaries", {"user_id": "probe"}, None),
+]
+
+
+class QueryPlanError(RuntimeError):
+    pass
+
+
+async def ensure_indexes(db) -> None:
+    for collection, models in INDEXES.items():
+        await db[collection].create_indexes(models)
+
+
+def _stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _stages(item)
+
+
+async def verify_query_plans(db) -> None:
+    problems = []
+    for collection, query, sort in HOT_QUERIES:
+        find = {"find": collection, "filter": query, "limit": 1}
+        if sort:
+            find["sort"] = sort
+        explained = await db.command({"explain": find, "verbosity": "queryPlanner"})
+        winning_plan = explained["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in set(_stages(winning_plan)):
+            problems.append(f"{collection} {query} sort={sort}")
+    if problems:
+        raise QueryPlanError("Hot queries fall back to COLLSCAN: " + "; ".join(problems))
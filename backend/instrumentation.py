@@ -0,0 +1,189 @@
+"""Latency, error and in-flight metrics for HTTP routes and MongoDB calls.
+
+``RequestMetricsMiddleware`` times every request until its response body has
+been sent, so streamed responses count in full, and labels it with the
+matched route template rather than the raw path. ``InstrumentedDatabase``
+wraps the Motor database so every collection handed out times its driver
+calls by collection and operation; anything it does not time is passed
+through untouched. It resolves the real database lazily, so repositories
+can be built at import time without opening a connection. Gemini calls are timed in ``ai.GeminiClient``.
+"""
+import time
+from typing import Any, Callable
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from metrics import Counter, Gauge, Histogram
+
+HTTP_REQUESTS = Counter("nutracia_http_requests_total", "HTTP requests by route, method and status")
+HTTP_DURATION = Histogram("nutracia_http_request_duration_seconds", "HTTP request latency by route and method")
+HTTP_IN_FLIGHT = Gauge("nutracia_http_requests_in_flight", "HTTP requests currently being served")
+
+MONGO_DURATION = Histogram(
+    "nutracia_mongo_operation_duration_seconds",
+    "MongoDB operation latency by collection and operation",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+MONGO_ERRORS = Counter("nutracia_mongo_operation_errors_total", "MongoDB operations that raised, by collection and operation")
+MONGO_IN_FLIGHT = Gauge("nutracia_mongo_operations_in_flight", "MongoDB operations currently awaiting the server")
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(method=method)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec(method=method)
+            # The router records the matched route in the scope; unmatched paths share one label
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            HTTP_DURATION.observe(time.perf_counter() - started, route=path, method=method)
+            HTTP_REQUESTS.inc(route=path, method=method, status=status_code)
+
+
+class _Timer:
+    def __init__(self, collection: str, operation: str):
+        self.labels = {"collection": collection, "operation": operation}
+
+    def __enter__(self):
+        MONGO_IN_FLIGHT.inc(**self.labels)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        MONGO_IN_FLIGHT.dec(**self.labels)
+        MONGO_DURATION.observe(time.perf_counter() - self.started, **self.labels)
+        # Cancellation is not a database error
+        if exc_type is not None and issubclass(exc_type, Exception):
+            MONGO_ERRORS.inc(**self.labels)
+        return False
+
+
+class InstrumentedCursor:
+    """Times the round trips of a find/aggregate cursor, not the caller's work between batches."""
+
+    def __init__(self, cursor, collection: str, operation: str):
+        self._cursor = cursor
+        self._collection = collection
+        self._operation = operation
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            # Keep chained sort()/limit() calls on the wrapper
+            return self if result is self._cursor else result
+
+        return call
+
+    async def to_list(self, *args, **kwargs):
+        with _Timer(self._collection, self._operation):
+            return await self._cursor.to_list(*args, **kwargs)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        iterator = self._cursor.__aiter__()
+        waited = 0.0
+        errored = False
+        labels = {"collection": self._collection, "operation": self._operation}
+        MONGO_IN_FLIGHT.inc(**labels)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    doc = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                except Exception:
+                    errored = True
+                    raise
+                finally:
+                    waited += time.perf_counter() - started
+                yield doc
+        finally:
+            MONGO_IN_FLIGHT.dec(**labels)
+            MONGO_DURATION.observe(waited, **labels)
+            if errored:
+                MONGO_ERRORS.inc(**labels)
+
+
+class InstrumentedCollection:
+    _TIMED = frozenset({
+        "bulk_write", "count_documents", "create_indexes", "delete_many", "delete_one", "distinct",
+        "find_one", "find_one_and_delete", "find_one_and_replace", "find_one_and_update",
+        "insert_many", "insert_one", "replace_one", "update_many", "update_one",
+    })
+    _CURSORS = frozenset({"find", "aggregate"})
+
+    def __init__(self, database: "InstrumentedDatabase", name: str):
+        self._database = database
+        self.name = name
+        self._bound = None
+
+    @property
+    def _collection(self):
+        # Bound on first use, and again if the database was replaced (new client after a fork)
+        raw = self._database.raw
+        if self._bound is None or self._bound[0] is not raw:
+            self._bound = (raw, raw[self.name])
+        return self._bound[1]
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name in self._TIMED:
+            async def timed(*args, **kwargs):
+                with _Timer(self.name, name):
+                    return await attr(*args, **kwargs)
+            return timed
+        if name in self._CURSORS:
+            return lambda *args, **kwargs: InstrumentedCursor(attr(*args, **kwargs), self.name, name)
+        return attr
+
+
+class InstrumentedDatabase:
+    """Wraps the database returned by ``resolve``, which is only called once a collection is used."""
+
+    def __init__(self, resolve: Callable[[], Any]):
+        self._resolve = resolve
+        self._collections = {}
+
+    @property
+    def raw(self):
+        return self._resolve()
+
+    def __getitem__(self, name: str) -> InstrumentedCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = InstrumentedCollection(self, name)
+        return collection
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        # Database methods such as command() pass through; any other name is a collection, as in Motor
+        if hasattr(AsyncIOMotorDatabase, name):
+            return getattr(self.raw, name)
+        return self[name]
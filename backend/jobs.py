@@ -0,0 +1,158 @@
+"""Asynchronous AI chat jobs with bounded concurrency and backpressure.
+
+``submit`` records a job and returns at once; a fixed pool of worker tasks
+runs queued jobs, so no more than ``concurrency`` Gemini calls are in flight
+for job mode no matter how many clients are waiting. Once ``max_queued``
+jobs are waiting, new submissions are refused with ``QueueFull`` instead of
+piling up. Job state lives in the ``ai_jobs`` collection so any worker can
+answer a poll; the worker that owns a job can also wake its long-pollers
+directly.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional
+
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUE_DEPTH = Gauge("nutracia_ai_jobs_queued", "AI jobs waiting for a worker")
+JOB_RUNNING = Gauge("nutracia_ai_jobs_running", "AI jobs currently being processed")
+JOB_WAIT = Histogram("nutracia_ai_job_wait_seconds", "Time AI jobs spend queued before a worker picks them up")
+JOB_DURATION = Histogram("nutracia_ai_job_duration_seconds", "Time AI jobs take once running")
+JOB_REJECTED = Counter("nutracia_ai_jobs_rejected_total", "AI jobs refused because the queue was full")
+JOB_FINISHED = Counter("nutracia_ai_jobs_finished_total", "AI jobs finished, by status")
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("AI job queue is full")
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    def __init__(
+        self,
+        db,
+        handler: Callable[[str, dict], Awaitable[dict]],
+        concurrency: int = 4,
+        max_queued: int = 100,
+        result_ttl: int = 3600,
+        retry_after: int = 5,
+    ):
+        self.collection = db.ai_jobs
+        self.handler = handler
+        self.concurrency = concurrency
+        self.result_ttl = result_ttl
+        self.retry_after = retry_after
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queued)
+        self._finished: Dict[str, asyncio.Event] = {}
+        self._running = set()
+        self._workers = []
+
+    def start(self) -> None:
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        # Unfinished jobs die with this process; tell their pollers instead of leaving them waiting
+        abandoned = list(self._running)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        while not self._queue.empty():
+            abandoned.append(self._queue.get_nowait()[0])
+        if abandoned:
+            await self.collection.update_many(
+                {"_id": {"$in": abandoned}, "status": {"$in": [QUEUED, RUNNING]}},
+                {"$set": {"status": FAILED, "error": "Server shutting down", "finished_at": datetime.utcnow()}},
+            )
+
+    def admit(self) -> None:
+        """Raise QueueFull if a submission would be refused right now."""
+        if self._queue.full():
+            JOB_REJECTED.inc()
+            raise QueueFull(self.retry_after)
+
+    async def submit(self, user_id: str, payload: dict) -> dict:
+        self.admit()
+        now = datetime.utcnow()
+        job = {
+            "_id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "status": QUEUED,
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=self.result_ttl),
+        }
+        await self.collection.insert_one(job)
+        self._finished[job["_id"]] = asyncio.Event()
+        # Re-checked after the insert: other submissions may have filled the queue meanwhile
+        try:
+            self._queue.put_nowait((job["_id"], user_id, payload, time.perf_counter()))
+        except asyncio.QueueFull:
+            JOB_REJECTED.inc()
+            self._finished.pop(job["_id"], None)
+            await self.collection.delete_one({"_id": job["_id"]})
+            raise QueueFull(self.retry_after)
+        JOB_QUEUE_DEPTH.set(self._queue.qsize())
+        return job
+
+    async def get(self, job_id: str, user_id: str) -> Optional[dict]:
+        return await self.collection.find_one({"_id": job_id, "user_id": user_id}, {"expires_at": 0})
+
+    async def wait(self, job_id: str, user_id: str, timeout: float, poll_interval: float = 0.5) -> Optional[dict]:
+        """Return the job once it has finished or ``timeout`` seconds have passed."""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = await self.get(job_id, user_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job["status"] in (DONE, FAILED) or remaining <= 0:
+                return job
+            event = self._finished.get(job_id)
+            try:
+                if event is not None:
+                    await asyncio.wait_for(event.wait(), remaining)
+                else:
+                    # Owned by another worker process
+                    await asyncio.sleep(min(poll_interval, remaining))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _work(self) -> None:
+        while True:
+            job_id, user_id, payload, enqueued_at = await self._queue.get()
+            JOB_QUEUE_DEPTH.set(self._queue.qsize())
+            JOB_WAIT.observe(time.perf_counter() - enqueued_at)
+            JOB_RUNNING.inc()
+            self._running.add(job_id)
+            started = time.perf_counter()
+            try:
+                await self.collection.update_one(
+                    {"_id": job_id}, {"$set": {"status": RUNNING, "started_at": datetime.utcnow()}}
+                )
+                try:
+                    result = await self.handler(user_id, payload)
+                    update = {"status": DONE, "result": result}
+                except Exception as e:
+                    logger.exception("AI job %s failed", job_id)
+                    update = {"status": FAILED, "error": str(e)}
+                update["finished_at"] = datetime.utcnow()
+                await self.collection.update_one({"_id": job_id}, {"$set": update})
+                JOB_FINISHED.inc(status=update["status"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Could not record outcome of AI job %s", job_id)
+            finally:
+                self._running.discard(job_id)
+                JOB_RUNNING.dec()
+                JOB_DURATION.observe(time.perf_counter() - started)
+                event = self._finished.pop(job_id, None)
+                if event is not None:
+                    event.set()
+                self._queue.task_done()
@@ -0,0 +1,125 @@
+"""Bounded conversation memory for chat prompts.
+
+A prompt carries a rolling summary of the whole conversation plus as many
+of the latest turns as fit in a token budget, so prompt size stays flat no
+matter how long a user has been chatting. The summary lives on the user
+document and is recomputed in the background every ``summarize_every`` turns.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """
+        Update the running summary of a conversation between a user and Nutracía, an AI wellness companion.
+        Keep facts about the user's situation, goals, constraints and the advice already given.
+        Write at most {max_words} words of plain prose.
+
+        Current summary:
+        {summary}
+
+        New turns:
+        {turns}
+        """
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English; close enough for budgeting
+    return len(text) // 4 + 1
+
+
+def format_turn(turn: dict) -> str:
+    return f"User: {turn.get('user_message', '')}\nNutracía: {turn.get('ai_response', '')}"
+
+
+class ConversationMemory:
+    _TURN_FIELDS = {"_id": 0, "user_message": 1, "ai_response": 1, "timestamp": 1}
+
+    def __init__(
+        self,
+        users,
+        chat_history,
+        gemini,
+        profile_cache=None,
+        max_turns: int = 6,
+        token_budget: int = 1500,
+        summarize_every: int = 10,
+        summary_max_words: int = 200,
+    ):
+        self.users = users
+        self.chat_history = chat_history
+        self.gemini = gemini
+        self.profile_cache = profile_cache
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.summarize_every = summarize_every
+        self.summary_max_words = summary_max_words
+        self._tasks = set()
+
+    async def recent_turns(self, user_id: str) -> List[dict]:
+        """The newest ``max_turns`` turns, newest first."""
+        if self.max_turns <= 0:
+            return []
+        return await self.chat_history.recent(user_id, self.max_turns, projection=self._TURN_FIELDS)
+
+    async def context(self, user: dict, turns: Optional[List[dict]] = None) -> str:
+        """Summary plus the newest turns that fit the budget, oldest first; '' for a new user.
+
+        ``turns`` (newest first) saves the history read for callers that already hold them.
+        """
+        summary = (user.get("memory") or {}).get("summary") or ""
+        budget = self.token_budget - estimate_tokens(summary)
+
+        kept: List[str] = []
+        if self.max_turns > 0 and budget > 0:
+            if turns is None:
+                turns = await self.recent_turns(user["id"])
+            for turn in turns[:self.max_turns]:
+                text = format_turn(turn)
+                cost = estimate_tokens(text)
+                if cost > budget:
+                    break
+                kept.append(text)
+                budget -= cost
+
+        sections = []
+        if summary:
+            sections.append(f"Summary of earlier conversation:\n{summary}")
+        if kept:
+            sections.append("Most recent turns:\n" + "\n".join(reversed(kept)))
+        return "\n\n".join(sections)
+
+    async def record_turn(self, user_id: str) -> None:
+        """Count a finished turn and start a summary refresh every ``summarize_every`` turns."""
+        if self.summarize_every <= 0:
+            return
+        turns = await self.users.increment_memory_turns(user_id)
+        if turns is not None and turns >= self.summarize_every:
+            task = asyncio.create_task(self._summarize(user_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _summarize(self, user_id: str) -> None:
+        try:
+            # Claiming resets the counter, so concurrent turns start one refresh, not several
+            memory = await self.users.claim_memory_refresh(user_id, self.summarize_every)
+            if memory is None:
+                return
+            summarized_through: Optional[datetime] = memory.get("summarized_through")
+            turns = await self.chat_history.recent(user_id, memory["turns"], projection=self._TURN_FIELDS)
+            turns = [t for t in turns if summarized_through is None or t["timestamp"] > summarized_through]
+            if not turns:
+                return
+            prompt = SUMMARY_PROMPT.format(
+                max_words=self.summary_max_words,
+                summary=memory.get("summary") or "(none yet)",
+                turns="\n".join(format_turn(t) for t in reversed(turns)),
+            )
+            summary = await self.gemini.generate(prompt)
+            await self.users.save_memory_summary(user_id, summary, turns[0]["timestamp"])
+            if self.profile_cache is not None:
+                self.profile_cache.invalidate(user_id)
+        except Exception:
+            logger.exception("Conversation summary refresh failed for user %s", user_id)
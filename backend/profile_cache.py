@@ -0,0 +1,96 @@
+"""Per-process cache of user profile documents.
+
+The profile, dashboard and chat paths all need the same user document, and
+chat needs it on every message. Entries are replaced on write by
+``update_profile`` (write-through) and otherwise expire after a TTL. With
+several workers, ``watch`` can follow a MongoDB change stream on ``users`` so
+an update made through one worker evicts the entry in every other worker;
+the ``profile_version`` counter bumped on each update tells those events
+apart from the ones this worker has already written through.
+"""
+import asyncio
+import logging
+from typing import Optional
+
+from metrics import Counter
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+PROFILE_CACHE_REQUESTS = Counter(
+    "nutracia_profile_cache_requests_total", "User profile cache lookups by result"
+)
+
+# Never cached: the password hash has no business on the read paths.
+_EXCLUDED_FIELDS = ("password", "_id")
+
+
+class ProfileCache:
+    def __init__(self, users, maxsize: int = 10000, ttl: int = 300):
+        self.users = users
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, user_id: str) -> Optional[dict]:
+        """The user's profile without password, or None if there is no such user.
+
+        Callers must not mutate the returned dict; it is shared.
+        """
+        profile = self.cache.get(user_id)
+        if profile is not None:
+            PROFILE_CACHE_REQUESTS.inc(result="hit")
+            return profile
+        PROFILE_CACHE_REQUESTS.inc(result="miss")
+        user = await self.users.find_by_id(user_id)
+        if user is None:
+            return None
+        return self.put(user)
+
+    async def version(self, user_id: str) -> Optional[int]:
+        """``profile_version`` from the cache, else from a projected read that leaves the cache alone."""
+        profile = self.cache.get(user_id)
+        if profile is not None:
+            return profile.get("profile_version", 0)
+        return await self.users.get_profile_version(user_id)
+
+    def put(self, user: dict) -> dict:
+        profile = {k: v for k, v in user.items() if k not in _EXCLUDED_FIELDS}
+        self.cache.set(profile["id"], profile)
+        return profile
+
+    def invalidate(self, user_id: str) -> None:
+        self.cache.pop(user_id)
+
+    def _on_change(self, document: dict) -> None:
+        user_id = document.get("id")
+        cached = self.cache.get(user_id) if user_id else None
+        # Our own write-through already holds this version; anything else is stale
+        if cached is not None and cached.get("profile_version") != document.get("profile_version"):
+            self.invalidate(user_id)
+
+    async def watch(self, opened: Optional[asyncio.Future] = None) -> None:
+        """Evict entries changed by other workers; runs until cancelled.
+
+        ``opened`` resolves once the stream is open; if the first attempt
+        fails it gets the exception instead and the watch gives up.
+        """
+        pipeline = [
+            {"$match": {"operationType": {"$in": ["update", "replace"]}}},
+            {"$project": {"fullDocument.id": 1, "fullDocument.profile_version": 1}},
+        ]
+        while True:
+            try:
+                async with self.users.collection.watch(pipeline, full_document="updateLookup") as stream:
+                    if opened is not None and not opened.done():
+                        opened.set_result(None)
+                    async for change in stream:
+                        self._on_change(change.get("fullDocument") or {})
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                if opened is not None and not opened.done():
+                    opened.set_exception(exc)
+                    return
+                # Events may have been missed while disconnected
+                logger.exception("Profile cache change stream failed; clearing cache and retrying")
+                self.cache.clear()
+                await asyncio.sleep(5)
@@ -0,0 +1,205 @@
+"""Per-user and per-IP rate limiting, and daily AI quota accounting.
+
+``RateLimiter.check`` first takes a token from an in-process token bucket,
+which turns away a burst without touching the database. Requests the local
+bucket allows are then counted in the shared ``rate_limits`` collection, a
+fixed-window counter per key that holds the limit across all workers. If
+MongoDB is unreachable the limiter falls back to the local buckets rather
+than failing requests.
+
+``DailyQuota`` counts AI requests per user per UTC day in ``ai_usage``; the
+counter only moves while it is below the limit, so the stored value is the
+usage the dashboard shows.
+"""
+import logging
+import math
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from metrics import Counter
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITED = Counter("nutracia_rate_limited_total", "Requests refused by a rate limit, by limiter, scope and tier")
+
+_PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+class RateLimited(Exception):
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(f"Rate limit exceeded ({scope})")
+        self.scope = scope
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class Rate:
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+
+    @classmethod
+    def parse(cls, spec: str) -> Optional["Rate"]:
+        """``"10/minute"`` -> 10 requests per 60 seconds; empty or ``"0/..."`` means no limit."""
+        if not spec:
+            return None
+        count, _, unit = spec.partition("/")
+        period = _PERIODS.get(unit.strip().rstrip("s"), None)
+        if period is None:
+            period = float(unit)
+        return cls(int(count), period) if int(count) > 0 else None
+
+
+class _TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, capacity: float):
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, rate: Rate) -> float:
+        """Take one token; returns 0 if allowed, else seconds until one is available."""
+        now = time.monotonic()
+        refill = rate.limit / rate.period
+        self.tokens = min(rate.limit, self.tokens + (now - self.updated) * refill)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / refill
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        db,
+        name: str,
+        per_user: Optional[Rate] = None,
+        per_ip: Optional[Rate] = None,
+        max_keys: int = 100000,
+    ):
+        self.collection = db.rate_limits if db is not None else None
+        self.name = name
+        self.per_user = per_user
+        self.per_ip = per_ip
+        self.max_keys = max_keys
+        self._buckets = {}
+        for scope, rate in (("user", per_user), ("ip", per_ip)):
+            if rate is not None:
+                # An idle bucket is full again after one period, so forgetting it then is free
+                self._buckets[scope] = TTLCache(maxsize=max_keys, ttl=rate.period)
+
+    async def check(self, user_id: Optional[str], ip: Optional[str]) -> None:
+        """Count one request; raises RateLimited if any applicable limit is exhausted."""
+        for scope, key, rate in (("user", user_id, self.per_user), ("ip", ip, self.per_ip)):
+            if rate is None or key is None:
+                continue
+            wait = self._take_local(scope, key, rate)
+            if wait:
+                RATE_LIMITED.inc(limiter=self.name, scope=scope, tier="memory")
+                raise RateLimited(scope, wait)
+            wait = await self._take_shared(scope, key, rate)
+            if wait:
+                RATE_LIMITED.inc(limiter=self.name, scope=scope, tier="mongo")
+                raise RateLimited(scope, wait)
+
+    def _take_local(self, scope: str, key: str, rate: Rate) -> float:
+        buckets = self._buckets[scope]
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = _TokenBucket(rate.limit)
+        wait = bucket.take(rate)
+        buckets.set(key, bucket)
+        return wait
+
+    async def _take_shared(self, scope: str, key: str, rate: Rate) -> float:
+        if self.collection is None:
+            return 0
+        now = time.time()
+        window = int(now // rate.period)
+        window_end = (window + 1) * rate.period
+        try:
+            doc = await self.collection.find_one_and_update(
+                {"_id": f"{self.name}:{scope}:{key}:{window}"},
+                {"$inc": {"count": 1}, "$setOnInsert": {"expires_at": datetime.utcfromtimestamp(window_end)}},
+                projection={"count": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except Exception:
+            # Degrade to the per-worker buckets rather than failing the request
+            logger.exception("Shared rate limit check failed for %s", self.name)
+            return 0
+        if doc["count"] > rate.limit:
+            return window_end - now
+        return 0
+
+
+def _day(now: datetime) -> str:
+    return now.strftime("%Y-%m-%d")
+
+
+def _next_midnight(now: datetime) -> datetime:
+    return datetime(now.year, now.month, now.day) + timedelta(days=1)
+
+
+class DailyQuota:
+    def __init__(self, db, limit: int, retention_days: int = 35):
+        """``limit`` of 0 records usage without enforcing a quota."""
+        self.collection = db.ai_usage
+        self.limit = limit
+        self.retention = timedelta(days=retention_days)
+
+    async def consume(self, user_id: str) -> int:
+        """Count one AI request for today; raises RateLimited once the quota is used up."""
+        now = datetime.utcnow()
+        day = _day(now)
+        key = f"{user_id}:{day}"
+        query = {"_id": key}
+        if self.limit > 0:
+            # Only matches while under the limit; at the limit the upsert collides on _id
+            query["requests"] = {"$lt": self.limit}
+        while True:
+            try:
+                doc = await self.collection.find_one_and_update(
+                    query,
+                    {
+                        "$inc": {"requests": 1},
+                        "$setOnInsert": {"user_id": user_id, "day": day, "expires_at": now + self.retention},
+                        "$set": {"last_request_at": now},
+                    },
+                    projection={"requests": 1},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+            except DuplicateKeyError:
+                # Also raised when a concurrent first request of the day inserted the document
+                # first; the server does not retry upserts whose filter is not all equality matches
+                stored = await self.collection.find_one({"_id": key}, {"requests": 1})
+                if not self.limit or stored is None or stored["requests"] < self.limit:
+                    continue
+                RATE_LIMITED.inc(limiter="ai_daily_quota", scope="user", tier="mongo")
+                raise RateLimited("daily quota", (_next_midnight(now) - now).total_seconds())
+            return doc["requests"]
+
+    async def refund(self, user_id: str) -> None:
+        """Give back one request counted today, for a request that was refused after all."""
+        await self.collection.update_one(
+            {"_id": f"{user_id}:{_day(datetime.utcnow())}", "requests": {"$gt": 0}},
+            {"$inc": {"requests": -1}},
+        )
+
+    async def usage(self, user_id: str) -> dict:
+        now = datetime.utcnow()
+        doc = await self.collection.find_one({"_id": f"{user_id}:{_day(now)}"}, {"requests": 1})
+        used = doc["requests"] if doc else 0
+        return {
+            "used": used,
+            "limit": self.limit or None,
+            "remaining": max(self.limit - used, 0) if self.limit else None,
+            "resets_at": _next_midnight(now),
+        }
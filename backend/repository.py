@@ -0,0 +1,313 @@
+"""Async data access for the users, chat_history, carts and dashboard summary collections.
+
+Route handlers go through these repositories instead of touching collections
+directly, so every MongoDB round trip is awaited on the event loop rather than
+blocking it.
+"""
+from datetime import datetime
+from typing import AsyncIterator, Optional, List, Tuple
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+class UserRepository:
+    def __init__(self, db):
+        self.collection = db.users
+
+    async def find_by_id(self, user_id: str) -> Optional[dict]:
+        return await self.collection.find_one({"id": user_id})
+
+    async def get_profile_version(self, user_id: str) -> Optional[int]:
+        """Just the ``profile_version``, for ETag checks; None if there is no such user."""
+        user = await self.collection.find_one({"id": user_id}, {"_id": 0, "profile_version": 1})
+        return user.get("profile_version", 0) if user else None
+
+    async def find_by_email(self, email: str) -> Optional[dict]:
+        return await self.collection.find_one({"email": email})
+
+    async def create(self, user_doc: dict) -> None:
+        await self.collection.insert_one(user_doc)
+
+    async def update(self, user_id: str, fields: dict) -> Optional[dict]:
+        """Apply ``fields``, bump ``profile_version`` and return the document as it was before.
+
+        Returns None if there is no such user.
+        """
+        return await self.collection.find_one_and_update(
+            {"id": user_id},
+            {"$set": fields, "$inc": {"profile_version": 1}},
+            projection={"password": 0},
+            return_document=ReturnDocument.BEFORE,
+        )
+
+    async def profile_groups(self, fields: Tuple[str, ...]) -> List[dict]:
+        """One document per distinct combination of ``fields`` across all users: ``{"_id": {...}, "users": n}``."""
+        pipeline = [{"$group": {"_id": {field: f"${field}" for field in fields}, "users": {"$sum": 1}}}]
+        return await self.collection.aggregate(pipeline, allowDiskUse=True).to_list(length=None)
+
+    async def increment_memory_turns(self, user_id: str) -> Optional[int]:
+        """Count a chat turn toward the next summary refresh; returns the new count."""
+        user = await self.collection.find_one_and_update(
+            {"id": user_id},
+            {"$inc": {"memory.turns": 1}},
+            projection={"_id": 0, "memory.turns": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        return user["memory"]["turns"] if user else None
+
+    async def claim_memory_refresh(self, user_id: str, min_turns: int) -> Optional[dict]:
+        """Reset the turn counter if it reached ``min_turns``; returns the memory as it was."""
+        user = await self.collection.find_one_and_update(
+            {"id": user_id, "memory.turns": {"$gte": min_turns}},
+            {"$set": {"memory.turns": 0}},
+            projection={"_id": 0, "memory": 1},
+            return_document=ReturnDocument.BEFORE,
+        )
+        return user["memory"] if user else None
+
+    async def save_memory_summary(self, user_id: str, summary: str, summarized_through: datetime) -> None:
+        await self.collection.update_one(
+            {"id": user_id},
+            {"$set": {"memory.summary": summary, "memory.summarized_through": summarized_through}},
+        )
+
+
+class ChatHistoryRepository:
+    def __init__(self, db, write_buffer=None):
+        self.collection = db.chat_history
+        # Optional WriteBehindBuffer; records then land in batches shortly after add() returns
+        self.write_buffer = write_buffer
+
+    async def add(self, chat_record: dict) -> None:
+        if self.write_buffer is not None:
+            await self.write_buffer.add(chat_record)
+        else:
+            await self.collection.insert_one(chat_record)
+
+    async def recent(self, user_id: str, limit: int, projection: Optional[dict] = None) -> List[dict]:
+        cursor = self.collection.find({"user_id": user_id}, projection).sort("timestamp", -1).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def count(self, user_id: str) -> int:
+        return await self.collection.count_documents({"user_id": user_id})
+
+    async def page(
+        self,
+        user_id: str,
+        limit: int,
+        before: Optional[Tuple[datetime, ObjectId]] = None,
+        preview_chars: Optional[int] = None,
+    ) -> List[dict]:
+        """Newest-first page of a user's chats, strictly older than ``before``.
+
+        Keyset pagination on (timestamp, _id) so every page is an index seek,
+        however deep the history. With ``preview_chars`` the answer is cut
+        down on the server and ``truncated`` says whether anything was dropped.
+        """
+        pipeline = [
+            {"$match": self._before(user_id, before)},
+            {"$sort": {"timestamp": -1, "_id": -1}},
+            {"$limit": limit},
+        ]
+        if preview_chars is not None:
+            pipeline.append({"$project": {
+                "user_message": 1,
+                "timestamp": 1,
+                "ai_response": {"$substrCP": ["$ai_response", 0, preview_chars]},
+                "truncated": {"$gt": [{"$strLenCP": "$ai_response"}, preview_chars]},
+            }})
+        return await self.collection.aggregate(pipeline).to_list(length=limit)
+
+    async def get(self, user_id: str, chat_id: ObjectId) -> Optional[dict]:
+        return await self.collection.find_one({"_id": chat_id, "user_id": user_id})
+
+    async def iterate(
+        self,
+        user_id: str,
+        before: Optional[Tuple[datetime, ObjectId]] = None,
+        since: Optional[datetime] = None,
+        oldest_first: bool = False,
+        batch_size: int = 100,
+    ) -> AsyncIterator[dict]:
+        """Every chat of ``user_id`` strictly older than ``before`` and newer than ``since``.
+
+        Newest first unless ``oldest_first``; the cursor holds at most
+        ``batch_size`` documents in memory at a time.
+        """
+        query = self._before(user_id, before)
+        if since is not None:
+            query["timestamp"] = {"$gt": since}
+        order = 1 if oldest_first else -1
+        cursor = self.collection.find(query).sort([("timestamp", order), ("_id", order)]).batch_size(batch_size)
+        async for chat in cursor:
+            yield chat
+
+    @staticmethod
+    def _before(user_id: str, before: Optional[Tuple[datetime, ObjectId]]) -> dict:
+        query = {"user_id": user_id}
+        if before is not None:
+            timestamp, chat_id = before
+            query["$or"] = [
+                {"timestamp": {"$lt": timestamp}},
+                {"timestamp": timestamp, "_id": {"$lt": chat_id}},
+            ]
+        return query
+
+
+class StaleCartVersion(Exception):
+    def __init__(self, current_version: int):
+        super().__init__(f"Cart is at version {current_version}")
+        self.current_version = current_version
+
+
+class CartItemNotFound(Exception):
+    pass
+
+
+class CartRepository:
+    """Carts carry a ``version`` that every write increments.
+
+    Delta operations only apply when the caller's version matches, so two tabs
+    editing the same cart cannot silently overwrite each other. Carts written
+    before versioning have no ``version`` field and count as version 0.
+    """
+
+    # Enough to report the new version and item count without shipping the cart back
+    _SUMMARY_PROJECTION = {"_id": 0, "version": 1, "items.product_name": 1}
+
+    def __init__(self, db):
+        self.collection = db.carts
+
+    async def get(self, user_id: str) -> Optional[dict]:
+        return await self.collection.find_one({"user_id": user_id})
+
+    async def replace(self, user_id: str, items: List[dict], at: datetime, expected_version: Optional[int] = None) -> int:
+        """Overwrite the item list and return the new version."""
+        query = {"user_id": user_id}
+        if expected_version is not None:
+            query.update(self._version_filter(expected_version))
+        try:
+            cart = await self.collection.find_one_and_update(
+                query,
+                {"$set": {"items": items, "updated_at": at}, "$inc": {"version": 1}},
+                projection=self._SUMMARY_PROJECTION,
+                upsert=expected_version in (None, 0),
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            cart = None
+        if cart is None:
+            raise StaleCartVersion(await self.version(user_id))
+        return cart["version"]
+
+    async def add_item(self, user_id: str, expected_version: int, item: dict, at: datetime) -> dict:
+        """Add ``item``, or raise its quantity if the cart already has that product."""
+        base = {"user_id": user_id, **self._version_filter(expected_version)}
+        cart = await self._apply(
+            {**base, "items.product_name": item["product_name"]},
+            {"$inc": {"items.$.quantity": item["quantity"], "version": 1}, "$set": {"updated_at": at}},
+        )
+        if cart is None:
+            try:
+                cart = await self._apply(
+                    {**base, "items.product_name": {"$ne": item["product_name"]}},
+                    {"$push": {"items": item}, "$inc": {"version": 1}, "$set": {"updated_at": at}},
+                    upsert=expected_version == 0,
+                )
+            except DuplicateKeyError:
+                # The cart exists at a newer version than the upsert assumed
+                cart = None
+        if cart is None:
+            raise StaleCartVersion(await self.version(user_id))
+        return cart
+
+    async def remove_item(self, user_id: str, expected_version: int, product_name: str, at: datetime) -> dict:
+        cart = await self._apply(
+            {"user_id": user_id, **self._version_filter(expected_version)},
+            {"$pull": {"items": {"product_name": product_name}}, "$inc": {"version": 1}, "$set": {"updated_at": at}},
+        )
+        if cart is None:
+            raise StaleCartVersion(await self.version(user_id))
+        return cart
+
+    async def set_quantity(self, user_id: str, expected_version: int, product_name: str, quantity: int, at: datetime) -> dict:
+        if quantity <= 0:
+            return await self.remove_item(user_id, expected_version, product_name, at)
+        cart = await self._apply(
+            {"user_id": user_id, **self._version_filter(expected_version), "items.product_name": product_name},
+            {"$set": {"items.$.quantity": quantity, "updated_at": at}, "$inc": {"version": 1}},
+        )
+        if cart is None:
+            current_version = await self.version(user_id)
+            if current_version == expected_version:
+                raise CartItemNotFound(product_name)
+            raise StaleCartVersion(current_version)
+        return cart
+
+    async def _apply(self, query: dict, update: dict, upsert: bool = False) -> Optional[dict]:
+        return await self.collection.find_one_and_update(
+            query,
+            update,
+            projection=self._SUMMARY_PROJECTION,
+            upsert=upsert,
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def version(self, user_id: str) -> int:
+        cart = await self.collection.find_one({"user_id": user_id}, {"_id": 0, "version": 1})
+        return (cart or {}).get("version", 0)
+
+    @staticmethod
+    def _version_filter(expected_version: int) -> dict:
+        if expected_version == 0:
+            return {"version": {"$in": [0, None]}}
+        return {"version": expected_version}
+
+
+class DashboardSummaryRepository:
+    """Per-user counters behind /api/dashboard, maintained incrementally by the write paths.
+
+    Updates never upsert: a missing summary is rebuilt from the source
+    collections on the next dashboard read instead of starting from zero.
+    Every write bumps ``revision``, which the dashboard's ETag is built on.
+    """
+
+    def __init__(self, db):
+        self.collection = db.dashboard_summaries
+
+    async def get(self, user_id: str, fields: Optional[Tuple[str, ...]] = None) -> Optional[dict]:
+        """The summary, or only ``fields`` of it."""
+        projection = {"_id": 0, **{field: 1 for field in fields}} if fields else {"_id": 0}
+        return await self.collection.find_one({"user_id": user_id}, projection)
+
+    async def save(self, summary: dict) -> None:
+        """Write the whole summary; sets ``summary["revision"]`` to the stored revision."""
+        fields = {k: v for k, v in summary.items() if k != "revision"}
+        saved = await self.collection.find_one_and_update(
+            {"user_id": summary["user_id"]},
+            {"$set": fields, "$inc": {"revision": 1}},
+            projection={"_id": 0, "revision": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        summary["revision"] = saved["revision"]
+
+    async def record_chat(self, user_id: str, at: datetime) -> None:
+        await self.collection.update_one(
+            {"user_id": user_id},
+            {"$inc": {"chat_count": 1, "revision": 1}, "$set": {"last_activity": at}},
+        )
+
+    async def set_cart_items(self, user_id: str, count: int, at: datetime) -> None:
+        await self.collection.update_one(
+            {"user_id": user_id},
+            {"$set": {"cart_items_count": count, "last_activity": at}, "$inc": {"revision": 1}},
+        )
+
+    async def set_profile(self, user_id: str, fields: dict, at: datetime) -> None:
+        await self.collection.update_one(
+            {"user_id": user_id},
+            {"$set": {**fields, "last_activity": at}, "$inc": {"revision": 1}},
+        )
@@ -0,0 +1,211 @@
+"""Deadlines, hedged requests and a circuit breaker for upstream calls.
+
+``ResilientCaller.call`` runs an upstream call under a deadline. Optionally it
+hedges: once the call has taken longer than a chosen percentile of recent
+latencies, a second identical call is started and whichever finishes first
+wins, which trims the tail without doubling load. Every outcome feeds a
+``CircuitBreaker``; after ``failure_threshold`` consecutive failures it opens
+and calls fail fast with ``CircuitOpen`` for ``reset_timeout`` seconds, then
+a single trial call decides whether it closes again. Callers turn
+``CircuitOpen`` into a cached or canned answer.
+"""
+import asyncio
+import math
+import time
+from collections import deque
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Optional, Tuple, Type, TypeVar
+
+from metrics import Counter, Gauge
+
+T = TypeVar("T")
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+BREAKER_STATE = Gauge("nutracia_circuit_breaker_state", "Circuit breaker state (0 closed, 1 half-open, 2 open)")
+BREAKER_TRANSITIONS = Counter("nutracia_circuit_breaker_transitions_total", "Circuit breaker state changes by new state")
+BREAKER_REJECTED = Counter("nutracia_circuit_breaker_rejected_total", "Calls refused because the circuit was open")
+UPSTREAM_TIMEOUTS = Counter("nutracia_upstream_timeouts_total", "Upstream calls that missed their deadline")
+HEDGED_CALLS = Counter("nutracia_hedged_requests_total", "Hedged second requests started, by which request won")
+
+
+class CircuitOpen(Exception):
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"{name} is unavailable (circuit open)")
+        self.retry_after = retry_after
+
+
+class UpstreamTimeout(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        BREAKER_STATE.set(_STATE_VALUES[CLOSED], name=name)
+
+    def before_call(self) -> None:
+        """Raise CircuitOpen unless a call may go upstream now."""
+        if self.state == OPEN:
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                BREAKER_REJECTED.inc(name=self.name)
+                raise CircuitOpen(self.name, math.ceil(remaining))
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            # One trial call at a time; everyone else keeps failing fast until it reports back
+            if self._trial_in_flight:
+                BREAKER_REJECTED.inc(name=self.name)
+                raise CircuitOpen(self.name, 1)
+            self._trial_in_flight = True
+
+    def record_success(self) -> None:
+        self._trial_in_flight = False
+        self._failures = 0
+        if self.state != CLOSED:
+            self._transition(CLOSED)
+
+    def record_failure(self) -> None:
+        self._trial_in_flight = False
+        self._failures += 1
+        if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            if self.state != OPEN:
+                self._transition(OPEN)
+
+    def record_abandoned(self) -> None:
+        """The call was cancelled by its caller; it says nothing about upstream health."""
+        self._trial_in_flight = False
+
+    def _transition(self, state: str) -> None:
+        self.state = state
+        BREAKER_STATE.set(_STATE_VALUES[state], name=self.name)
+        BREAKER_TRANSITIONS.inc(name=self.name, state=state)
+
+
+class LatencyWindow:
+    """Latencies of the last ``size`` successful calls."""
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, pct: float, min_samples: int) -> Optional[float]:
+        if len(self._samples) < min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[max(1, math.ceil(pct / 100 * len(ordered))) - 1]
+
+
+class ResilientCaller:
+    def __init__(
+        self,
+        name: str,
+        timeout: float,
+        breaker: CircuitBreaker,
+        hedge_percentile: Optional[float] = None,
+        hedge_min_samples: int = 20,
+        ignore: Tuple[Type[BaseException], ...] = (),
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.breaker = breaker
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        # Errors that are about the request, not upstream health (e.g. a blocked prompt)
+        self.ignore = ignore
+        self.latencies = LatencyWindow()
+
+    async def _deadline(self, aw: Awaitable[T]) -> T:
+        try:
+            return await asyncio.wait_for(aw, self.timeout)
+        except asyncio.TimeoutError:
+            UPSTREAM_TIMEOUTS.inc(name=self.name)
+            raise UpstreamTimeout(f"{self.name} did not answer within {self.timeout:g}s")
+
+    async def call(self, fn: Callable[[], Awaitable[T]]) -> T:
+        self.breaker.before_call()
+        started = time.perf_counter()
+        try:
+            result = await self._deadline(self._hedged(fn))
+        except self.ignore:
+            self.breaker.record_success()
+            raise
+        except asyncio.CancelledError:
+            self.breaker.record_abandoned()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        self.latencies.add(time.perf_counter() - started)
+        return result
+
+    async def stream(self, open_stream: Callable[[], Awaitable[AsyncIterable[T]]]) -> AsyncIterator[T]:
+        """``call`` for streamed responses, without hedging.
+
+        The deadline applies to opening the stream and to each wait for the
+        next item, so a long answer is fine but a stalled one is not.
+        """
+        self.breaker.before_call()
+        outcome = None
+        try:
+            iterator = (await self._deadline(open_stream())).__aiter__()
+            while True:
+                try:
+                    item = await self._deadline(iterator.__anext__())
+                except StopAsyncIteration:
+                    break
+                yield item
+            outcome = "success"
+        except self.ignore:
+            outcome = "success"
+            raise
+        except Exception:
+            outcome = "failure"
+            raise
+        finally:
+            if outcome == "success":
+                self.breaker.record_success()
+            elif outcome == "failure":
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_abandoned()
+
+    async def _hedged(self, fn: Callable[[], Awaitable[T]]) -> T:
+        delay = None
+        if self.hedge_percentile:
+            delay = self.latencies.percentile(self.hedge_percentile, self.hedge_min_samples)
+        if delay is None:
+            return await fn()
+
+        first = asyncio.ensure_future(fn())
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return first.result()
+            second = asyncio.ensure_future(fn())
+            tasks.append(second)
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        HEDGED_CALLS.inc(name=self.name, winner="hedge" if task is second else "original")
+                        return task.result()
+                    error = task.exception()
+            HEDGED_CALLS.inc(name=self.name, winner="none")
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
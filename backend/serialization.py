@@ -0,0 +1,127 @@
+"""Response encoding: orjson by default, msgpack on request, gzip above a size threshold.
+
+``NegotiatedResponse`` renders with orjson, or with msgpack when the client
+sends ``Accept: application/msgpack`` and the msgpack package is installed.
+The request's Accept header reaches it through a context variable set by
+``ContentNegotiationMiddleware``. ``NegotiatedRoute`` hands a route's return
+value straight to ``NegotiatedResponse`` instead of running it through
+``jsonable_encoder`` first; that recursive walk costs more than the encoding
+itself on large payloads such as chat history pages.
+
+``SelectiveGZipMiddleware`` is Starlette's GZipMiddleware minus the streamed
+routes, whose chunks the compressor would otherwise hold back.
+"""
+import asyncio
+import functools
+from contextvars import ContextVar
+from datetime import date, datetime
+from typing import Any, Iterable
+
+import orjson
+from fastapi.datastructures import DefaultPlaceholder
+from fastapi.encoders import jsonable_encoder
+from fastapi.routing import APIRoute
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response
+
+try:
+    import msgpack
+except ImportError:  # msgpack negotiation is optional
+    msgpack = None
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+_accept: ContextVar[str] = ContextVar("accept", default="")
+
+
+def _orjson_default(obj: Any) -> Any:
+    # Anything orjson does not know natively (ObjectId, pydantic models, ...)
+    return jsonable_encoder(obj)
+
+
+def _msgpack_default(obj: Any) -> Any:
+    if isinstance(obj, (datetime, date)):
+        # Same representation as the JSON responses
+        return obj.isoformat()
+    return jsonable_encoder(obj)
+
+
+def wants_msgpack(accept: str) -> bool:
+    return msgpack is not None and any(media_type in accept for media_type in MSGPACK_MEDIA_TYPES)
+
+
+def negotiated_format() -> str:
+    """``"msgpack"`` or ``"json"``: what NegotiatedResponse will render for the current request."""
+    return "msgpack" if wants_msgpack(_accept.get()) else "json"
+
+
+class NegotiatedResponse(Response):
+    media_type = "application/json"
+
+    def __init__(self, content: Any = None, *args, **kwargs):
+        self._msgpack = wants_msgpack(_accept.get())
+        if self._msgpack:
+            self.media_type = MSGPACK_MEDIA_TYPES[0]
+        super().__init__(content, *args, **kwargs)
+        self.headers.append("Vary", "Accept")
+
+    def render(self, content: Any) -> bytes:
+        if self._msgpack:
+            return msgpack.packb(content, default=_msgpack_default, use_bin_type=True)
+        return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class NegotiatedRoute(APIRoute):
+    def get_route_handler(self):
+        endpoint = self.dependant.call
+        if (
+            self.response_field is None
+            and isinstance(self.response_class, DefaultPlaceholder)
+            and asyncio.iscoroutinefunction(endpoint)
+            and not getattr(endpoint, "_negotiated", False)
+        ):
+            status_code = self.status_code or 200
+
+            @functools.wraps(endpoint)
+            async def call(**values):
+                content = await endpoint(**values)
+                if isinstance(content, Response):
+                    return content
+                return NegotiatedResponse(content, status_code=status_code)
+
+            call._negotiated = True
+            self.dependant.call = call
+        return super().get_route_handler()
+
+
+class ContentNegotiationMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept = ""
+        for name, value in scope["headers"]:
+            if name == b"accept":
+                accept = value.decode("latin-1")
+                break
+        token = _accept.set(accept)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _accept.reset(token)
+
+
+class SelectiveGZipMiddleware:
+    def __init__(self, app, minimum_size: int = 1000, compresslevel: int = 6, exclude_paths: Iterable[str] = ()):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size, compresslevel=compresslevel)
+        self.exclude_paths = tuple(exclude_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and not scope["path"].startswith(self.exclude_paths):
+            await self.gzip(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
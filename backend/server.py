@@ -1,48 +1,263 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import APIRouter, FastAPI, HTTPException, Depends, Header, Query, Request, WebSocket, WebSocketDisconnect, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List
+from contextlib import asynccontextmanager
 import os
+import asyncio
 from dotenv import load_dotenv
-import pymongo
-from pymongo import MongoClient
-import bcrypt
-from jose import JWTError, jwt
-from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, timedelta, timezone
 import google.generativeai as genai
+import time
 import uuid
 import json
+import base64
+from bson import ObjectId
+from bson.errors import InvalidId
 
-load_dotenv()
+from ai import GeminiClient, build_prompt
+from auth import InvalidToken, TokenAuthenticator
+from chat_buckets import BucketedChatHistoryRepository, ChatCompactor
+from chat_cache import FINGERPRINT_FIELDS, ResponseCache, profile_fingerprint
+from chat_sessions import ChatSession, SessionRegistry, TooManySessions
+from clients import MongoConnection
+from conditional import etag_matches, make_etag, not_modified, tagged_response
+from export import coalesce, export_records, gzip_stream
+from hashing import PasswordHasher, HasherSaturated
+from indexes import ensure_indexes, verify_query_plans
+from instrumentation import InstrumentedDatabase, RequestMetricsMiddleware
+from jobs import JobQueue, QueueFull
+from memory import ConversationMemory
+from metrics import render_prometheus
+from profile_cache import ProfileCache
+from rate_limit import DailyQuota, Rate, RateLimited, RateLimiter
+from repository import (
+    UserRepository, ChatHistoryRepository, CartRepository, DashboardSummaryRepository,
+    StaleCartVersion, CartItemNotFound,
+)
+from resilience import CircuitBreaker, CircuitOpen, ResilientCaller, UpstreamTimeout
+from serialization import (
+    ContentNegotiationMiddleware, NegotiatedResponse, NegotiatedRoute, SelectiveGZipMiddleware,
+)
+from tips import TIP_FIELDS, DailyTips, tip_fingerprint
+from write_behind import WriteBehindBuffer
 
-app = FastAPI(title="Nutracía API", version="1.0.0")
+load_dotenv()
 
-# CORS setup
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Routes are collected on a router; create_app() builds the application around it
+router = APIRouter(route_class=NegotiatedRoute, default_response_class=NegotiatedResponse)
 
 # Security
 security = HTTPBearer()
 
+# Worker processes started by the launcher below (0 means one per core). Caches stay per
+# worker, so more than one needs PROFILE_CACHE_CHANGE_STREAM to read back its own profile writes.
+WORKERS = int(os.getenv("WORKERS", "1")) or os.cpu_count() or 1
+
 # MongoDB setup
 MONGO_URL = os.getenv("MONGO_URL")
-client = MongoClient(MONGO_URL)
-db = client.nutracia_db
+# The client is created on first use in each worker; the pool is per worker, so
+# the server holds up to WORKERS x MONGO_MAX_POOL_SIZE connections in total
+mongo = MongoConnection(
+    MONGO_URL,
+    "nutracia_db",
+    maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "50")),
+    minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+    maxIdleTimeMS=int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000")),
+    waitQueueTimeoutMS=int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000")),
+    serverSelectionTimeoutMS=int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+)
+db = InstrumentedDatabase(lambda: mongo.database)
+users = UserRepository(db)
+# Chat history layout: "documents" (one per message) or "buckets" (per user per day, archived when old)
+CHAT_HISTORY_STORAGE = os.getenv("CHAT_HISTORY_STORAGE", "documents").lower()
+chat_write_buffer = None
+chat_compactor = None
+if CHAT_HISTORY_STORAGE == "buckets":
+    chat_history = BucketedChatHistoryRepository(
+        db,
+        max_per_bucket=int(os.getenv("CHAT_BUCKET_MAX_MESSAGES", "200")),
+        ttl_days=int(os.getenv("CHAT_BUCKET_TTL_DAYS", "0")),
+        compression_level=int(os.getenv("CHAT_ARCHIVE_COMPRESSION_LEVEL", "6")),
+    )
+    # Archives buckets older than CHAT_ARCHIVE_AFTER_DAYS and drains the old chat_history collection
+    chat_compactor = ChatCompactor(
+        chat_history,
+        archive_after_days=int(os.getenv("CHAT_ARCHIVE_AFTER_DAYS", "30")),
+        interval=float(os.getenv("CHAT_COMPACT_INTERVAL", "3600")),
+        batch_size=int(os.getenv("CHAT_COMPACT_BATCH", "100")),
+    )
+else:
+    # Optional write-behind batching of chat_history inserts
+    if os.getenv("CHAT_WRITE_BEHIND", "").lower() in ("1", "true", "yes"):
+        chat_write_buffer = WriteBehindBuffer(
+            db.chat_history,
+            max_batch=int(os.getenv("CHAT_WRITE_BEHIND_BATCH", "100")),
+            flush_interval=float(os.getenv("CHAT_WRITE_BEHIND_INTERVAL", "0.5")),
+            max_pending=int(os.getenv("CHAT_WRITE_BEHIND_MAX_PENDING", "10000")),
+        )
+    chat_history = ChatHistoryRepository(db, write_buffer=chat_write_buffer)
+carts = CartRepository(db)
+dashboard_summaries = DashboardSummaryRepository(db)
+VERIFY_QUERY_PLANS = os.getenv("VERIFY_QUERY_PLANS", "1").lower() in ("1", "true", "yes")
+
+# Profile cache shared by the profile, dashboard and chat paths
+profile_cache = ProfileCache(
+    users,
+    maxsize=int(os.getenv("PROFILE_CACHE_MAX_ENTRIES", "10000")),
+    ttl=int(os.getenv("PROFILE_CACHE_TTL", "300")),
+)
+# On by default with several workers, where a profile write lands in only one worker's cache
+PROFILE_CACHE_CHANGE_STREAM = os.getenv(
+    "PROFILE_CACHE_CHANGE_STREAM", "1" if WORKERS > 1 else ""
+).lower() in ("1", "true", "yes")
+background_tasks = []
+
+# Chat history listing returns answers cut to this many characters unless full=true
+CHAT_HISTORY_PREVIEW_CHARS = int(os.getenv("CHAT_HISTORY_PREVIEW_CHARS", "200"))
+# WebSocket chat: open sessions per user and per worker, sockets per worker still authenticating
+# (each may wait WS_AUTH_TIMEOUT seconds), server pings every WS_HEARTBEAT_INTERVAL seconds,
+# and a session that sends nothing for WS_IDLE_TIMEOUT seconds is closed
+websocket_sessions = SessionRegistry(
+    max_per_user=int(os.getenv("WS_MAX_SESSIONS_PER_USER", "3")),
+    max_total=int(os.getenv("WS_MAX_SESSIONS", "1000")),
+    max_pending=int(os.getenv("WS_MAX_PENDING_AUTH", "100")),
+)
+WS_AUTH_TIMEOUT = float(os.getenv("WS_AUTH_TIMEOUT", "10"))
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "25"))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "75"))
+# Close codes in the 4000 range mirror the HTTP status they stand for
+WS_UNAUTHORIZED, WS_NOT_FOUND, WS_IDLE, WS_TOO_MANY_SESSIONS = 4401, 4404, 4408, 4429
+
+# Chats per cursor batch while exporting, and the gzip level for ?gzip=true
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "100"))
+# Bucket cursors count day buckets rather than chats, each holding up to max_per_bucket of them
+EXPORT_CURSOR_BATCH_SIZE = (
+    max(1, EXPORT_BATCH_SIZE // chat_history.max_per_bucket) if CHAT_HISTORY_STORAGE == "buckets" else EXPORT_BATCH_SIZE
+)
+EXPORT_GZIP_LEVEL = int(os.getenv("EXPORT_GZIP_LEVEL", "6"))
+
+# Cache-Control per route; profile, dashboard and cart are revalidated with their ETag on every poll
+CACHE_CONTROL_PROFILE = os.getenv("CACHE_CONTROL_PROFILE", "private, no-cache")
+CACHE_CONTROL_DASHBOARD = os.getenv("CACHE_CONTROL_DASHBOARD", "private, no-cache")
+CACHE_CONTROL_CART = os.getenv("CACHE_CONTROL_CART", "private, no-cache")
+CACHE_CONTROL_CHAT_HISTORY = os.getenv("CACHE_CONTROL_CHAT_HISTORY", "private, no-store")
+# A stored chat message never changes
+CACHE_CONTROL_CHAT_MESSAGE = os.getenv("CACHE_CONTROL_CHAT_MESSAGE", "private, max-age=3600")
+# Summary fields a conditional dashboard request reads before deciding on a 304
+DASHBOARD_ETAG_FIELDS = ("revision", "tip_fingerprint")
 
 # Gemini AI setup
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-2.5-flash')
+
+def create_gemini_model():
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.GenerativeModel('gemini-2.5-flash')
+
+# Deadline per call, optional hedging past a latency percentile (0 = off), circuit breaker
+gemini = GeminiClient(create_gemini_model, ResilientCaller(
+    "gemini",
+    timeout=float(os.getenv("GEMINI_TIMEOUT", "30")),
+    breaker=CircuitBreaker(
+        "gemini",
+        failure_threshold=int(os.getenv("GEMINI_BREAKER_FAILURES", "5")),
+        reset_timeout=float(os.getenv("GEMINI_BREAKER_RESET_TIMEOUT", "30")),
+    ),
+    hedge_percentile=float(os.getenv("GEMINI_HEDGE_PERCENTILE", "0")) or None,
+    hedge_min_samples=int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20")),
+    # response.text raises ValueError for blocked prompts; that is not an outage
+    ignore=(ValueError,),
+))
+AI_UNAVAILABLE_MESSAGE = (
+    "Our AI wellness assistant is temporarily unavailable. Please try again in a few minutes. "
+    "If you have an urgent health concern, please consult a healthcare professional."
+)
+
+# AI response cache (in-process tier always on, shared Mongo tier opt-in)
+response_cache = ResponseCache(
+    db=db if os.getenv("CHAT_CACHE_MONGO", "").lower() in ("1", "true", "yes") else None,
+    maxsize=int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "1024")),
+    ttl=int(os.getenv("CHAT_CACHE_TTL", "3600")),
+    shared_ttl=int(os.getenv("CHAT_CACHE_MONGO_TTL", "86400")),
+)
+
+# Conversation memory: rolling summary plus the latest turns, within a token budget.
+# Off by default (0 turns, no summaries): a prompt that carries conversation context
+# bypasses the response cache and request coalescing, so with memory on only a user's
+# first message can be answered from cache. Suggested when on: 6 turns, a summary every 10.
+conversation_memory = ConversationMemory(
+    users,
+    chat_history,
+    gemini,
+    profile_cache=profile_cache,
+    max_turns=int(os.getenv("CHAT_MEMORY_TURNS", "0")),
+    token_budget=int(os.getenv("CHAT_MEMORY_TOKEN_BUDGET", "1500")),
+    summarize_every=int(os.getenv("CHAT_MEMORY_SUMMARY_EVERY", "0")),
+)
+
+# AI job mode: a fixed pool of workers bounds concurrent Gemini calls
+chat_jobs = JobQueue(
+    db,
+    handler=lambda user_id, payload: run_chat_job(user_id, payload),
+    concurrency=int(os.getenv("AI_JOB_CONCURRENCY", "4")),
+    max_queued=int(os.getenv("AI_JOB_MAX_QUEUED", "100")),
+    result_ttl=int(os.getenv("AI_JOB_RESULT_TTL", "3600")),
+    retry_after=int(os.getenv("AI_JOB_RETRY_AFTER", "5")),
+)
+
+# Daily tips: one Gemini call per distinct profile group per day, re-checked every
+# DAILY_TIPS_BATCH_INTERVAL seconds (0 = only when `python tips.py` is run, e.g. from cron)
+daily_tips = DailyTips(
+    db,
+    users,
+    gemini,
+    maxsize=int(os.getenv("DAILY_TIPS_CACHE_MAX_ENTRIES", "10000")),
+    ttl=int(os.getenv("DAILY_TIPS_CACHE_TTL", "600")),
+    concurrency=int(os.getenv("DAILY_TIPS_CONCURRENCY", "4")),
+)
+DAILY_TIPS_BATCH_INTERVAL = float(os.getenv("DAILY_TIPS_BATCH_INTERVAL", "3600"))
 
 # JWT setup
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM")
+# Verified tokens are cached; revocations are re-read from Mongo every AUTH_REVOCATION_SYNC_INTERVAL seconds
+authenticator = TokenAuthenticator(
+    db,
+    JWT_SECRET_KEY,
+    JWT_ALGORITHM,
+    token_ttl=timedelta(hours=24),
+    cache_size=int(os.getenv("AUTH_TOKEN_CACHE_MAX_ENTRIES", "10000")),
+    sync_interval=float(os.getenv("AUTH_REVOCATION_SYNC_INTERVAL", "10")),
+)
+
+# Only trust X-Forwarded-For behind a proxy that sets it
+TRUST_FORWARDED_FOR = os.getenv("TRUST_FORWARDED_FOR", "").lower() in ("1", "true", "yes")
+
+# Rate limits ("<count>/<second|minute|hour|day>", empty = off) and the daily AI quota (0 = record only).
+# Behind the ingress every request comes from the proxy's address unless TRUST_FORWARDED_FOR
+# is set, so per-IP limits are off by default then; setting RATE_LIMIT_*_IP turns them on anyway.
+chat_rate_limiter = RateLimiter(
+    db,
+    "chat",
+    per_user=Rate.parse(os.getenv("RATE_LIMIT_CHAT_USER", "10/minute")),
+    per_ip=Rate.parse(os.getenv("RATE_LIMIT_CHAT_IP", "30/minute" if TRUST_FORWARDED_FOR else "")),
+)
+auth_rate_limiter = RateLimiter(
+    db, "auth", per_ip=Rate.parse(os.getenv("RATE_LIMIT_AUTH_IP", "20/minute" if TRUST_FORWARDED_FOR else ""))
+)
+# Exports walk a user's whole history, so they get a much lower limit of their own
+export_rate_limiter = RateLimiter(db, "export", per_user=Rate.parse(os.getenv("RATE_LIMIT_EXPORT_USER", "5/hour")))
+ai_quota = DailyQuota(db, limit=int(os.getenv("AI_DAILY_QUOTA", "200")))
+
+# Password hashing pool (defaults to this worker's share of the cores)
+password_hasher = PasswordHasher(
+    workers=int(os.getenv("PASSWORD_HASH_WORKERS", "0")) or max(1, (os.cpu_count() or 1) // WORKERS),
+    max_pending=int(os.getenv("PASSWORD_HASH_MAX_PENDING", "0")) or None,
+    retry_after=int(os.getenv("PASSWORD_HASH_RETRY_AFTER", "1")),
+)
 
 # Pydantic models
 class User(BaseModel):
@@ -76,47 +291,158 @@ class CartItem(BaseModel):
 class CartSync(BaseModel):
     user_id: str
     items: List[CartItem]
+    version: Optional[int] = None  # when set, reject the sync if the cart has moved on
+
+class CartPatch(BaseModel):
+    version: int
+    op: str  # "add", "remove" or "set_quantity"
+    item: Optional[CartItem] = None
+    product_name: Optional[str] = None
+    quantity: Optional[int] = None
 
 # Helper functions
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+async def hash_password(password: str) -> str:
+    try:
+        return await password_hasher.hash(password)
+    except HasherSaturated as e:
+        raise HTTPException(status_code=503, detail="Server busy, please retry", headers={"Retry-After": str(e.retry_after)})
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+async def verify_password(password: str, hashed: str) -> bool:
+    try:
+        return await password_hasher.verify(password, hashed)
+    except HasherSaturated as e:
+        raise HTTPException(status_code=503, detail="Server busy, please retry", headers={"Retry-After": str(e.retry_after)})
 
 def create_access_token(data: dict):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(hours=24)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
-    return encoded_jwt
+    return authenticator.create_access_token(data["sub"])
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+# async so FastAPI runs these on the event loop: a cached token costs a dict lookup,
+# not a threadpool hop, and the token cache is only ever touched from one thread
+async def get_current_claims(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-        return user_id
-    except JWTError:
+        return authenticator.verify(credentials.credentials)
+    except InvalidToken:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
 
+async def get_current_user(claims: dict = Depends(get_current_claims)):
+    return claims["sub"]
+
+def client_ip(request: Request) -> Optional[str]:
+    if TRUST_FORWARDED_FOR:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else None
+
+def too_many_requests(e: RateLimited) -> HTTPException:
+    detail = "Daily AI quota exceeded" if e.scope == "daily quota" else "Too many requests, please slow down"
+    return HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(e.retry_after)})
+
+async def limit_auth(request: Request):
+    try:
+        await auth_rate_limiter.check(None, client_ip(request))
+    except RateLimited as e:
+        raise too_many_requests(e)
+
+async def charge_chat(request: Request, user_id: str) -> None:
+    """Apply the chat rate limits and daily AI quota; call once the request is authorized and accepted."""
+    try:
+        await chat_rate_limiter.check(user_id, client_ip(request))
+        await ai_quota.consume(user_id)
+    except RateLimited as e:
+        raise too_many_requests(e)
+
+async def limit_export(current_user: str = Depends(get_current_user)) -> str:
+    try:
+        await export_rate_limiter.check(current_user, None)
+    except RateLimited as e:
+        raise too_many_requests(e)
+    return current_user
+
+# Set once startup has finished; /health/ready reports 503 until then and after shutdown begins
+ready = asyncio.Event()
+READINESS_TIMEOUT = float(os.getenv("READINESS_TIMEOUT", "2"))
+
+async def startup():
+    await ensure_indexes(db)
+    await response_cache.ensure_indexes()
+    await authenticator.sync()
+    background_tasks.append(asyncio.create_task(authenticator.run_sync()))
+    if VERIFY_QUERY_PLANS:
+        await verify_query_plans(db)
+    if PROFILE_CACHE_CHANGE_STREAM:
+        # Other workers' profile writes only reach this cache through the stream, so refuse to start without it
+        opened = asyncio.get_running_loop().create_future()
+        background_tasks.append(asyncio.create_task(profile_cache.watch(opened)))
+        await opened
+    chat_jobs.start()
+    if chat_write_buffer is not None:
+        chat_write_buffer.start()
+    if chat_compactor is not None:
+        background_tasks.append(asyncio.create_task(chat_compactor.run()))
+    if DAILY_TIPS_BATCH_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(daily_tips.run(DAILY_TIPS_BATCH_INTERVAL)))
+    ready.set()
+
+async def shutdown():
+    ready.clear()
+    await chat_jobs.stop()
+    if chat_write_buffer is not None:
+        await chat_write_buffer.stop()
+    for task in background_tasks:
+        task.cancel()
+    password_hasher.shutdown()
+    mongo.close()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
 # API Routes
-@app.get("/")
+@router.get("/")
 async def root():
     return {"message": "Nutracía API - Your Intelligent Wellness Companion"}
 
-@app.post("/api/signup")
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
+@router.get("/health/live")
+async def liveness():
+    return {"status": "alive"}
+
+@router.get("/health/ready")
+async def readiness():
+    checks = {"startup": ready.is_set(), "mongodb": False}
+    if checks["startup"]:
+        try:
+            await asyncio.wait_for(db.command("ping"), timeout=READINESS_TIMEOUT)
+            checks["mongodb"] = True
+        except Exception:
+            pass
+    body = {
+        "status": "ready" if all(checks.values()) else "unavailable",
+        "checks": checks,
+        # Informational only: with the breaker open chat still answers from the fallback
+        "gemini_circuit": gemini.caller.breaker.state,
+    }
+    return NegotiatedResponse(body, status_code=200 if body["status"] == "ready" else 503)
+
+@router.post("/api/signup", dependencies=[Depends(limit_auth)])
 async def signup(user: User):
     try:
         # Check if user already exists
-        existing_user = db.users.find_one({"email": user.email})
+        existing_user = await users.find_by_email(user.email)
         if existing_user:
             raise HTTPException(status_code=400, detail="Email already registered")
         
         # Create new user
         user_id = str(uuid.uuid4())
-        hashed_password = hash_password(user.password)
+        hashed_password = await hash_password(user.password)
         
         user_doc = {
             "id": user_id,
@@ -125,11 +451,25 @@ async def signup(user: User):
             "name": user.name,
             "age": user.age,
             "health_goals": user.health_goals,
+            "profile_version": 1,
             "created_at": datetime.utcnow(),
             "updated_at": datetime.utcnow()
         }
         
-        db.users.insert_one(user_doc)
+        try:
+            await users.create(user_doc)
+        except DuplicateKeyError:
+            # Lost a race with a concurrent signup for the same email
+            raise HTTPException(status_code=400, detail="Email already registered")
+        await dashboard_summaries.save({
+            "user_id": user_id,
+            "name": user.name,
+            "health_goals": user.health_goals,
+            "chat_count": 0,
+            "cart_items_count": 0,
+            "last_activity": user_doc["created_at"],
+            "tip_fingerprint": tip_fingerprint(user_doc),
+        })
         
         # Create access token
         access_token = create_access_token(data={"sub": user_id})
@@ -140,19 +480,21 @@ async def signup(user: User):
             "access_token": access_token,
             "token_type": "bearer"
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create user: {str(e)}")
 
-@app.post("/api/login")
+@router.post("/api/login", dependencies=[Depends(limit_auth)])
 async def login(user_login: UserLogin):
     try:
         # Find user
-        user = db.users.find_one({"email": user_login.email})
+        user = await users.find_by_email(user_login.email)
         if not user:
             raise HTTPException(status_code=401, detail="Invalid email or password")
         
         # Verify password
-        if not verify_password(user_login.password, user["password"]):
+        if not await verify_password(user_login.password, user["password"]):
             raise HTTPException(status_code=401, detail="Invalid email or password")
         
         # Create access token
@@ -169,27 +511,53 @@ async def login(user_login: UserLogin):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Login failed: {str(e)}")
 
-@app.get("/api/profile/{user_id}")
-async def get_profile(user_id: str, current_user: str = Depends(get_current_user)):
+@router.post("/api/logout")
+async def logout(claims: dict = Depends(get_current_claims)):
+    try:
+        await authenticator.revoke(claims)
+        return {"message": "Logged out"}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Logout failed: {str(e)}")
+
+@router.post("/api/sessions/revoke-all")
+async def revoke_all_sessions(current_user: str = Depends(get_current_user)):
+    try:
+        await authenticator.revoke_all(current_user)
+        return {"message": "All sessions revoked"}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to revoke sessions: {str(e)}")
+
+@router.get("/api/profile/{user_id}")
+async def get_profile(
+    user_id: str,
+    if_none_match: Optional[str] = Header(None),
+    current_user: str = Depends(get_current_user),
+):
     try:
         if current_user != user_id:
             raise HTTPException(status_code=403, detail="Access denied")
         
-        user = db.users.find_one({"id": user_id})
+        if if_none_match:
+            version = await profile_cache.version(user_id)
+            if version is not None and etag_matches(if_none_match, make_etag("profile", user_id, version)):
+                return not_modified(make_etag("profile", user_id, version), CACHE_CONTROL_PROFILE)
+        
+        user = await profile_cache.get(user_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Remove password from response
-        user.pop("password", None)
-        user.pop("_id", None)
-        
-        return user
+        # Cached profiles never carry the password or _id
+        return tagged_response(
+            {k: v for k, v in user.items() if k != "memory"},
+            make_etag("profile", user_id, user.get("profile_version", 0)),
+            CACHE_CONTROL_PROFILE,
+        )
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get profile: {str(e)}")
 
-@app.put("/api/profile/{user_id}")
+@router.put("/api/profile/{user_id}")
 async def update_profile(user_id: str, profile: UserProfile, current_user: str = Depends(get_current_user)):
     try:
         if current_user != user_id:
@@ -198,130 +566,658 @@ async def update_profile(user_id: str, profile: UserProfile, current_user: str =
         update_data = profile.dict(exclude_unset=True)
         update_data["updated_at"] = datetime.utcnow()
         
-        result = db.users.update_one(
-            {"id": user_id},
-            {"$set": update_data}
-        )
+        previous = await users.update(user_id, update_data)
         
-        if result.matched_count == 0:
+        if previous is None:
             raise HTTPException(status_code=404, detail="User not found")
         
+        # Write-through so the next read on this worker sees the update
+        profile_cache.put({**previous, **update_data, "profile_version": previous.get("profile_version", 0) + 1})
+        
+        # Cached answers were keyed on the old profile
+        if any(field in update_data for field in FINGERPRINT_FIELDS):
+            old_fingerprint = profile_fingerprint(previous)
+            if profile_fingerprint({**previous, **update_data}) != old_fingerprint:
+                await response_cache.invalidate(old_fingerprint)
+        
+        summary_fields = {k: v for k, v in update_data.items() if k in ("name", "health_goals")}
+        if any(field in update_data for field in TIP_FIELDS):
+            summary_fields["tip_fingerprint"] = tip_fingerprint({**previous, **update_data})
+        await dashboard_summaries.set_profile(user_id, summary_fields, update_data["updated_at"])
+        
         return {"message": "Profile updated successfully"}
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to update profile: {str(e)}")
 
-@app.get("/api/dashboard/{user_id}")
-async def get_dashboard(user_id: str, current_user: str = Depends(get_current_user)):
+async def rebuild_dashboard_summary(user_id: str):
+    user = await profile_cache.get(user_id)
+    if not user:
+        return None
+    chat_count, cart = await asyncio.gather(chat_history.count(user_id), carts.get(user_id))
+    summary = {
+        "user_id": user_id,
+        "name": user.get("name", "User"),
+        "health_goals": user.get("health_goals", []),
+        "chat_count": chat_count,
+        "cart_items_count": len(cart.get("items", [])) if cart else 0,
+        "last_activity": user.get("updated_at"),
+        "tip_fingerprint": tip_fingerprint(user),
+    }
+    await dashboard_summaries.save(summary)
+    return summary
+
+@router.get("/api/dashboard/{user_id}")
+async def get_dashboard(
+    user_id: str,
+    if_none_match: Optional[str] = Header(None),
+    current_user: str = Depends(get_current_user),
+):
     try:
         if current_user != user_id:
             raise HTTPException(status_code=403, detail="Access denied")
         
-        # Get user info
-        user = db.users.find_one({"id": user_id})
-        if not user:
+        # Single point read; rebuilt from users/chat_history/carts only if missing.
+        # A conditional request first reads just what the ETag is built from.
+        fields = DASHBOARD_ETAG_FIELDS if if_none_match else None
+        summary, ai_usage = await asyncio.gather(dashboard_summaries.get(user_id, fields), ai_quota.usage(user_id))
+        if summary is None:
+            summary = await rebuild_dashboard_summary(user_id)
+            fields = None
+        if summary is None:
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Get recent chat history
-        chat_history = list(db.chat_history.find({"user_id": user_id}).sort("timestamp", -1).limit(5))
+        # Summaries written before tips existed lack the fingerprint
+        fingerprint = summary.get("tip_fingerprint")
+        if fingerprint is None:
+            fingerprint = tip_fingerprint(await profile_cache.get(user_id) or {})
+        daily_tip = await daily_tips.get(fingerprint)
         
-        # Get cart items
-        cart = db.carts.find_one({"user_id": user_id})
-        cart_items = cart.get("items", []) if cart else []
+        etag = make_etag("dashboard", user_id, summary.get("revision", 0), ai_usage["used"], ai_usage["resets_at"], daily_tip)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag, CACHE_CONTROL_DASHBOARD)
+        if fields is not None:
+            summary = await dashboard_summaries.get(user_id) or summary
         
         # Create dashboard data
         dashboard = {
             "user_id": user_id,
-            "name": user.get("name", "User"),
-            "health_goals": user.get("health_goals", []),
-            "recent_chats": len(chat_history),
-            "cart_items_count": len(cart_items),
-            "daily_tip": "Stay hydrated! Aim for 8 glasses of water daily for optimal wellness.",
+            "name": summary.get("name", "User"),
+            "health_goals": summary.get("health_goals", []),
+            "recent_chats": min(summary.get("chat_count", 0), 5),
+            "total_chats": summary.get("chat_count", 0),
+            "cart_items_count": summary.get("cart_items_count", 0),
+            "last_activity": summary.get("last_activity"),
+            "ai_usage": ai_usage,
+            "daily_tip": daily_tip,
             "last_updated": datetime.utcnow()
         }
         
-        return dashboard
+        return tagged_response(dashboard, etag, CACHE_CONTROL_DASHBOARD)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get dashboard: {str(e)}")
 
-@app.post("/api/cart/sync")
+@router.post("/api/cart/sync")
 async def sync_cart(cart_data: CartSync, current_user: str = Depends(get_current_user)):
     try:
         if current_user != cart_data.user_id:
             raise HTTPException(status_code=403, detail="Access denied")
         
-        cart_doc = {
-            "user_id": cart_data.user_id,
-            "items": [item.dict() for item in cart_data.items],
-            "updated_at": datetime.utcnow()
-        }
+        items = [item.dict() for item in cart_data.items]
+        updated_at = datetime.utcnow()
         
-        db.carts.replace_one(
-            {"user_id": cart_data.user_id},
-            cart_doc,
-            upsert=True
-        )
+        version = await carts.replace(cart_data.user_id, items, updated_at, expected_version=cart_data.version)
+        await dashboard_summaries.set_cart_items(cart_data.user_id, len(items), updated_at)
         
-        return {"message": "Cart synced successfully", "items_count": len(cart_data.items)}
+        return {"message": "Cart synced successfully", "items_count": len(cart_data.items), "version": version}
+    except StaleCartVersion as e:
+        raise HTTPException(status_code=409, detail=f"Cart has changed; current version is {e.current_version}")
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to sync cart: {str(e)}")
 
-@app.post("/api/chat/ai")
-async def chat_with_ai(chat_message: ChatMessage, current_user: str = Depends(get_current_user)):
+@router.get("/api/cart/{user_id}")
+async def get_cart(
+    user_id: str,
+    if_none_match: Optional[str] = Header(None),
+    current_user: str = Depends(get_current_user),
+):
+    try:
+        if current_user != user_id:
+            raise HTTPException(status_code=403, detail="Access denied")
+        
+        if if_none_match:
+            etag = make_etag("cart", user_id, await carts.version(user_id))
+            if etag_matches(if_none_match, etag):
+                return not_modified(etag, CACHE_CONTROL_CART)
+        
+        cart = await carts.get(user_id) or {}
+        return tagged_response(
+            {
+                "user_id": user_id,
+                "items": cart.get("items", []),
+                "version": cart.get("version", 0),
+                "updated_at": cart.get("updated_at")
+            },
+            make_etag("cart", user_id, cart.get("version", 0)),
+            CACHE_CONTROL_CART,
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get cart: {str(e)}")
+
+@router.patch("/api/cart/{user_id}")
+async def patch_cart(user_id: str, patch: CartPatch, current_user: str = Depends(get_current_user)):
+    try:
+        if current_user != user_id:
+            raise HTTPException(status_code=403, detail="Access denied")
+        
+        updated_at = datetime.utcnow()
+        if patch.op == "add":
+            if patch.item is None:
+                raise HTTPException(status_code=400, detail="'add' requires an item")
+            if patch.item.quantity <= 0:
+                # Lowering or clearing a quantity is set_quantity's job
+                raise HTTPException(status_code=400, detail="'add' requires a positive quantity")
+            cart = await carts.add_item(user_id, patch.version, patch.item.dict(), updated_at)
+        elif patch.op == "remove":
+            if patch.product_name is None:
+                raise HTTPException(status_code=400, detail="'remove' requires a product_name")
+            cart = await carts.remove_item(user_id, patch.version, patch.product_name, updated_at)
+        elif patch.op == "set_quantity":
+            if patch.product_name is None or patch.quantity is None:
+                raise HTTPException(status_code=400, detail="'set_quantity' requires a product_name and quantity")
+            cart = await carts.set_quantity(user_id, patch.version, patch.product_name, patch.quantity, updated_at)
+        else:
+            raise HTTPException(status_code=400, detail=f"Unknown cart operation: {patch.op}")
+        
+        items_count = len(cart.get("items", []))
+        await dashboard_summaries.set_cart_items(user_id, items_count, updated_at)
+        
+        return {"message": "Cart updated successfully", "items_count": items_count, "version": cart["version"]}
+    except StaleCartVersion as e:
+        raise HTTPException(status_code=409, detail=f"Cart has changed; current version is {e.current_version}")
+    except CartItemNotFound as e:
+        raise HTTPException(status_code=404, detail=f"Item not in cart: {e}")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to update cart: {str(e)}")
+
+async def prepare_chat(user: dict, message: str, turns: Optional[List[dict]] = None):
+    """Render the prompt and look up a cached answer; returns (prompt, fingerprint, cached answer)."""
+    conversation = await conversation_memory.context(user, turns)
+    fingerprint = profile_fingerprint(user)
+    # Answers that drew on earlier turns are specific to this conversation, so
+    # only context-free prompts go through the shared response cache
+    cached_response = None if conversation else await response_cache.get(message, fingerprint)
+    # The cache key leaves the name out, so a shareable prompt must too
+    prompt = build_prompt(user, message, conversation, with_name=bool(conversation))
+    return prompt, (None if conversation else fingerprint), cached_response
+
+async def fallback_answer(user: dict, message: str) -> str:
+    """What to answer while Gemini's circuit is open: any cached answer for this profile, else a canned notice."""
+    cached = await response_cache.get(message, profile_fingerprint(user))
+    return cached or AI_UNAVAILABLE_MESSAGE
+
+async def record_chat(user_id: str, message: str, ai_response: str) -> dict:
+    chat_record = {
+        "user_id": user_id,
+        "user_message": message,
+        "ai_response": ai_response,
+        "timestamp": datetime.utcnow()
+    }
+    await asyncio.gather(
+        chat_history.add(chat_record),
+        dashboard_summaries.record_chat(user_id, chat_record["timestamp"]),
+    )
+    await conversation_memory.record_turn(user_id)
+    return chat_record
+
+@router.post("/api/chat/ai")
+async def chat_with_ai(chat_message: ChatMessage, request: Request, current_user: str = Depends(get_current_user)):
     try:
         if current_user != chat_message.user_id:
             raise HTTPException(status_code=403, detail="Access denied")
+        await charge_chat(request, current_user)
         
         # Get user context
-        user = db.users.find_one({"id": chat_message.user_id})
+        user = await profile_cache.get(chat_message.user_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Create context-aware prompt
-        context = f"""
-        You are Nutracía, an intelligent medical-grade AI wellness companion. 
-        You provide evidence-based guidance on nutrition, skincare, and fitness.
-        
-        User Context:
-        - Name: {user.get('name', 'User')}
-        - Age: {user.get('age', 'Not specified')}
-        - Health Goals: {', '.join(user.get('health_goals', []))}
-        - Dietary Preferences: {', '.join(user.get('dietary_preferences', []))}
-        - Fitness Level: {user.get('fitness_level', 'Not specified')}
-        
-        Always provide professional, evidence-based advice. If the question is outside your scope or requires medical diagnosis, recommend consulting a healthcare professional.
-        
-        User Question: {chat_message.message}
-        """
-        
-        # Generate AI response
-        response = model.generate_content(context)
-        ai_response = response.text
-        
-        # Save chat history
-        chat_record = {
-            "user_id": chat_message.user_id,
-            "user_message": chat_message.message,
-            "ai_response": ai_response,
-            "timestamp": datetime.utcnow()
-        }
-        db.chat_history.insert_one(chat_record)
-        
-        return {
-            "message": "AI response generated",
-            "response": ai_response,
-            "timestamp": datetime.utcnow()
-        }
+        answer = await answer_chat(user, chat_message.message)
+        message = "AI temporarily unavailable" if answer.get("degraded") else "AI response generated"
+        return {"message": message, **answer}
     except HTTPException:
         raise
+    except UpstreamTimeout:
+        raise HTTPException(status_code=504, detail="AI response timed out")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI chat failed: {str(e)}")
 
+async def answer_chat(user: dict, message: str) -> dict:
+    """Answer ``message`` in one piece and record it; shared by the blocking chat route and chat jobs."""
+    # Generate AI response unless someone with the same profile asked the same question
+    context, fingerprint, ai_response = await prepare_chat(user, message)
+    if ai_response is None:
+        try:
+            ai_response = await gemini.generate(context)
+        except CircuitOpen:
+            # Fail fast while Gemini is down; fallback answers are not recorded
+            return {"response": await fallback_answer(user, message), "timestamp": datetime.utcnow(), "degraded": True}
+        if fingerprint:
+            await response_cache.set(message, fingerprint, ai_response)
+    
+    # Save chat history
+    chat_record = await record_chat(user["id"], message, ai_response)
+    return {"response": ai_response, "timestamp": chat_record["timestamp"]}
+
+async def stream_answer(message: str, context: str, fingerprint: Optional[str], cached_response: Optional[str], parts: List[str]):
+    """Yield the answer's text as it arrives, collecting it in ``parts``; raises CircuitOpen before any chunk."""
+    if cached_response is not None:
+        parts.append(cached_response)
+        yield cached_response
+        return
+    async for text in gemini.stream(context):
+        parts.append(text)
+        yield text
+    if fingerprint:
+        await asyncio.shield(response_cache.set(message, fingerprint, "".join(parts)))
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# A text/plain stream is already 200 when a failure happens, so a truncated answer ends
+# with this marker line plus the error; an answer without it is complete
+STREAM_ERROR_MARKER = "\n\n[nutracia:error] "
+
+@router.post("/api/chat/ai/stream")
+async def chat_with_ai_stream(chat_message: ChatMessage, request: Request, current_user: str = Depends(get_current_user)):
+    if current_user != chat_message.user_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    await charge_chat(request, current_user)
+    
+    try:
+        user = await profile_cache.get(chat_message.user_id)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        context, fingerprint, cached_response = await prepare_chat(user, chat_message.message)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"AI chat failed: {str(e)}")
+    use_sse = "text/event-stream" in request.headers.get("accept", "")
+    
+    async def body():
+        # Runs as its own task; Starlette cancels it when the client disconnects,
+        # in which case nothing is persisted and the upstream stream is dropped.
+        parts = []
+        try:
+            async for text in stream_answer(chat_message.message, context, fingerprint, cached_response, parts):
+                yield sse_event("chunk", {"text": text}) if use_sse else text
+        except CircuitOpen:
+            # Raised before any chunk; fallback answers are not recorded
+            fallback = await fallback_answer(user, chat_message.message)
+            yield sse_event("chunk", {"text": fallback}) if use_sse else fallback
+            if use_sse:
+                yield sse_event("done", {"timestamp": datetime.utcnow().isoformat(), "degraded": True})
+            return
+        except Exception as e:
+            detail = f"AI chat failed: {str(e)}"
+            yield sse_event("error", {"detail": detail}) if use_sse else f"{STREAM_ERROR_MARKER}{detail}\n"
+            return
+        
+        # Shielded so a disconnect after the last chunk still records the answer
+        chat_record = await asyncio.shield(record_chat(chat_message.user_id, chat_message.message, "".join(parts)))
+        
+        if use_sse:
+            yield sse_event("done", {"timestamp": chat_record["timestamp"].isoformat()})
+    
+    return StreamingResponse(
+        body(),
+        media_type="text/event-stream" if use_sse else "text/plain",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def receive_frame(websocket: WebSocket):
+    """The next frame, parsed as JSON; raises ValueError for a binary or malformed frame."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    # receive_json() would fail with KeyError on a binary frame
+    if message.get("text") is None:
+        raise ValueError("binary frame")
+    return json.loads(message["text"])
+
+async def authenticate_websocket(websocket: WebSocket) -> Optional[tuple]:
+    """(claims, token) from the Authorization header or a first ``auth`` frame; None if invalid."""
+    scheme, _, token = websocket.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        # Browsers cannot set headers on a WebSocket, so the token may come as the first frame
+        try:
+            frame = await asyncio.wait_for(receive_frame(websocket), WS_AUTH_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        except ValueError:
+            await websocket.send_json({"type": "error", "detail": "Frames must be JSON text"})
+            return None
+        token = frame.get("token") if isinstance(frame, dict) and frame.get("type") == "auth" else None
+    try:
+        return authenticator.verify(token or ""), token
+    except InvalidToken:
+        return None
+
+async def answer_over_websocket(websocket: WebSocket, session: ChatSession, frame: dict, ip: Optional[str]) -> bool:
+    """Answer one chat frame; returns False once the session has to end."""
+    ref = frame.get("id")
+    message = frame.get("message")
+    if not isinstance(message, str) or not message.strip():
+        await websocket.send_json({"type": "error", "id": ref, "detail": "'chat' requires a message"})
+        return True
+    try:
+        await chat_rate_limiter.check(session.user_id, ip)
+        await ai_quota.consume(session.user_id)
+    except RateLimited as e:
+        await websocket.send_json({
+            "type": "error", "id": ref, "detail": too_many_requests(e).detail, "retry_after": e.retry_after,
+        })
+        return True
+    
+    user = await profile_cache.get(session.user_id)
+    if not user:
+        await websocket.close(code=WS_NOT_FOUND, reason="User not found")
+        return False
+    if session.is_stale(user):
+        session.load(user, await conversation_memory.recent_turns(session.user_id))
+    
+    parts = []
+    try:
+        context, fingerprint, cached_response = await prepare_chat(user, message, session.turns)
+        async for text in stream_answer(message, context, fingerprint, cached_response, parts):
+            await websocket.send_json({"type": "chunk", "id": ref, "text": text})
+    except CircuitOpen:
+        fallback = await fallback_answer(user, message)
+        await websocket.send_json({"type": "chunk", "id": ref, "text": fallback})
+        await websocket.send_json({"type": "done", "id": ref, "timestamp": datetime.utcnow().isoformat(), "degraded": True})
+        return True
+    except WebSocketDisconnect:
+        raise
+    except Exception as e:
+        await websocket.send_json({"type": "error", "id": ref, "detail": f"AI chat failed: {str(e)}"})
+        return True
+    
+    # Shielded so a disconnect after the last chunk still records the answer
+    chat_record = await asyncio.shield(record_chat(session.user_id, message, "".join(parts)))
+    session.add_turn(chat_record)
+    await websocket.send_json({"type": "done", "id": ref, "timestamp": chat_record["timestamp"].isoformat()})
+    return True
+
+@router.websocket("/api/chat/ws")
+async def chat_websocket(websocket: WebSocket):
+    """Chat over one socket: authenticate once, then send ``{"type": "chat", "message": ..., "id": ...}`` frames.
+
+    Answers stream back as ``chunk`` frames followed by ``done`` (or ``error``)
+    carrying the same ``id``. The server sends ``ping`` frames; any frame from
+    the client, such as ``pong``, keeps the session alive.
+    """
+    try:
+        # Refused before the handshake completes once too many sockets are still authenticating
+        with websocket_sessions.authenticating():
+            await websocket.accept()
+            auth = await authenticate_websocket(websocket)
+        if auth is None:
+            await websocket.close(code=WS_UNAUTHORIZED, reason="Invalid authentication credentials")
+            return
+        claims, token = auth
+        session = ChatSession(claims["sub"], token, conversation_memory.max_turns)
+        with websocket_sessions.open(session.user_id):
+            await run_websocket_session(websocket, session)
+    except TooManySessions as e:
+        await websocket.close(code=WS_TOO_MANY_SESSIONS, reason=str(e))
+    except WebSocketDisconnect:
+        pass
+
+async def run_websocket_session(websocket: WebSocket, session: ChatSession) -> None:
+    user = await profile_cache.get(session.user_id)
+    if not user:
+        await websocket.close(code=WS_NOT_FOUND, reason="User not found")
+        return
+    session.load(user, await conversation_memory.recent_turns(session.user_id))
+    await websocket.send_json({"type": "ready", "user_id": session.user_id, "profile_version": user.get("profile_version")})
+    
+    ip = client_ip(websocket)
+    last_seen = time.monotonic()
+    while True:
+        try:
+            frame = await asyncio.wait_for(receive_frame(websocket), WS_HEARTBEAT_INTERVAL)
+        except asyncio.TimeoutError:
+            if time.monotonic() - last_seen >= WS_IDLE_TIMEOUT:
+                await websocket.close(code=WS_IDLE, reason="Idle timeout")
+                return
+            frame = None
+        except ValueError:
+            await websocket.send_json({"type": "error", "detail": "Frames must be JSON text"})
+            continue
+        
+        # Cached after the first check, so this only notices logouts and expiry
+        try:
+            authenticator.verify(session.token)
+        except InvalidToken:
+            await websocket.close(code=WS_UNAUTHORIZED, reason="Session expired or revoked")
+            return
+        
+        if frame is None:
+            await websocket.send_json({"type": "ping"})
+            continue
+        last_seen = time.monotonic()
+        kind = frame.get("type") if isinstance(frame, dict) else None
+        if kind == "ping":
+            await websocket.send_json({"type": "pong"})
+        elif kind == "chat":
+            if not await answer_over_websocket(websocket, session, frame, ip):
+                return
+        elif kind != "pong":
+            await websocket.send_json({"type": "error", "detail": f"Unknown frame type: {kind}"})
+
+async def run_chat_job(user_id: str, payload: dict) -> dict:
+    user = await profile_cache.get(user_id)
+    if not user:
+        raise ValueError("User not found")
+    return await answer_chat(user, payload["message"])
+
+@router.post("/api/chat/jobs", status_code=202)
+async def submit_chat_job(chat_message: ChatMessage, request: Request, current_user: str = Depends(get_current_user)):
+    if current_user != chat_message.user_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    try:
+        # A full queue turns the request away before it is charged
+        chat_jobs.admit()
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail="AI is busy, please retry", headers={"Retry-After": str(e.retry_after)})
+    await charge_chat(request, current_user)
+    
+    try:
+        job = await chat_jobs.submit(chat_message.user_id, {"message": chat_message.message})
+    except QueueFull as e:
+        # The last slot went to a concurrent submission after this one was charged
+        await ai_quota.refund(current_user)
+        raise HTTPException(status_code=503, detail="AI is busy, please retry", headers={"Retry-After": str(e.retry_after)})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to queue AI chat: {str(e)}")
+    
+    return {"job_id": job["_id"], "status": job["status"], "created_at": job["created_at"]}
+
+@router.get("/api/chat/jobs/{job_id}")
+async def get_chat_job(
+    job_id: str,
+    wait: float = Query(0, ge=0, le=30),
+    current_user: str = Depends(get_current_user),
+):
+    try:
+        job = await chat_jobs.wait(job_id, current_user, timeout=wait)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get AI job: {str(e)}")
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    job["job_id"] = job.pop("_id")
+    return job
+
+def encode_history_cursor(chat: dict) -> str:
+    raw = f"{chat['timestamp'].isoformat()}|{chat['_id']}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_history_cursor(cursor: str):
+    try:
+        timestamp, chat_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        return datetime.fromisoformat(timestamp), ObjectId(chat_id)
+    except (ValueError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def serialize_chat(chat: dict) -> dict:
+    return {
+        "id": str(chat["_id"]),
+        "user_message": chat.get("user_message"),
+        "ai_response": chat.get("ai_response"),
+        "timestamp": chat.get("timestamp")
+    }
+
+@router.get("/api/chat/history/{user_id}")
+async def get_chat_history(
+    user_id: str,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    full: bool = False,
+    current_user: str = Depends(get_current_user),
+):
+    if current_user != user_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    before = decode_history_cursor(cursor) if cursor else None
+    
+    try:
+        chats = await chat_history.page(
+            user_id,
+            limit,
+            before=before,
+            preview_chars=None if full else CHAT_HISTORY_PREVIEW_CHARS,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get chat history: {str(e)}")
+    
+    items = []
+    for chat in chats:
+        item = serialize_chat(chat)
+        if not full:
+            item["truncated"] = chat.get("truncated", False)
+        items.append(item)
+    
+    return tagged_response(
+        {
+            "items": items,
+            "next_cursor": encode_history_cursor(chats[-1]) if len(chats) == limit else None
+        },
+        None,
+        CACHE_CONTROL_CHAT_HISTORY,
+    )
+
+@router.get("/api/chat/history/{user_id}/{chat_id}")
+async def get_chat_message(user_id: str, chat_id: str, current_user: str = Depends(get_current_user)):
+    if current_user != user_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    if not ObjectId.is_valid(chat_id):
+        raise HTTPException(status_code=404, detail="Chat not found")
+    
+    try:
+        chat = await chat_history.get(user_id, ObjectId(chat_id))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get chat: {str(e)}")
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    
+    return tagged_response(serialize_chat(chat), None, CACHE_CONTROL_CHAT_MESSAGE)
+
+@router.get("/api/export/{user_id}")
+async def export_user_data(
+    user_id: str,
+    since: Optional[datetime] = None,
+    gzip: bool = False,
+    current_user: str = Depends(limit_export),
+):
+    """Profile, cart and chat history as NDJSON; ``since`` resumes after the last chat timestamp received."""
+    if current_user != user_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    if since is not None and since.tzinfo is not None:
+        # Stored timestamps are naive UTC
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    
+    try:
+        user, cart = await asyncio.gather(profile_cache.get(user_id), carts.get(user_id))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to export data: {str(e)}")
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    profile = {k: v for k, v in user.items() if k != "memory"}
+    chats = chat_history.iterate(user_id, since=since, oldest_first=True, batch_size=EXPORT_CURSOR_BATCH_SIZE)
+    body = coalesce(export_records(profile, cart, chats, since))
+    filename = f"nutracia-export-{user_id}.ndjson"
+    if gzip:
+        body = gzip_stream(body, EXPORT_GZIP_LEVEL)
+        filename += ".gz"
+    return StreamingResponse(
+        body,
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+def create_app() -> FastAPI:
+    # orjson for every route, msgpack for clients that ask for it
+    app = FastAPI(
+        title="Nutracía API", version="1.0.0", default_response_class=NegotiatedResponse, lifespan=lifespan
+    )
+
+    # CORS setup
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.add_middleware(ContentNegotiationMiddleware)
+    # Compress responses above GZIP_MIN_SIZE bytes; streamed routes are left alone so chunks are not held back
+    app.add_middleware(
+        SelectiveGZipMiddleware,
+        minimum_size=int(os.getenv("GZIP_MIN_SIZE", "1000")),
+        compresslevel=int(os.getenv("GZIP_LEVEL", "6")),
+        exclude_paths=("/api/chat/ai/stream", "/api/export/"),
+    )
+    app.add_middleware(RequestMetricsMiddleware)
+    app.include_router(router)
+    return app
+
+app = create_app()
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    # Each worker imports this module and builds its own app, Mongo pool and Gemini client;
+    # they inherit the resolved count so per-worker pools can size themselves to their share
+    os.environ["WORKERS"] = str(WORKERS)
+    uvicorn.run(
+        "server:create_app",
+        factory=True,
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8001")),
+        workers=WORKERS,
+    )
\ No newline at end of file
@@ -0,0 +1,32 @@
+"""Coalesce concurrent identical async calls into one."""
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+from metrics import Counter
+
+T = TypeVar("T")
+
+COALESCED_CALLS = Counter(
+    "nutracia_singleflight_coalesced_total", "Calls that joined an identical in-flight call instead of starting one"
+)
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """Run ``fn()`` unless a call for ``key`` is already running, then share its outcome.
+
+        The shared call runs as its own task, so a caller that gets cancelled
+        (say, its client disconnected) does not cancel it for the others.
+        """
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            COALESCED_CALLS.inc(call=self.name)
+        return await asyncio.shield(task)
@@ -0,0 +1,178 @@
+"""Personalized daily tips, generated in a batch and served from cache.
+
+Users are grouped by a fingerprint of the profile fields a tip depends on.
+``DailyTips.generate`` asks Gemini for one tip per group per UTC day and
+stores it in ``daily_tips``, so the number of Gemini calls follows the number
+of distinct profiles rather than dashboard traffic. ``DailyTips.get`` is the
+dashboard's lookup: a per-process cache in front of a point read, falling back
+to a generic tip for profiles the batch has not reached yet.
+
+Each group is claimed by inserting a pending document before Gemini is
+called, so several workers (or a cron run of ``python tips.py``) running the
+batch at once never pay for the same tip twice. A claim whose worker died
+expires through the TTL index and is picked up by the next run.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from chat_cache import profile_fingerprint
+from metrics import Counter
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Profile fields a tip is written for; users who agree on all of them share one
+TIP_FIELDS = ("health_goals", "dietary_preferences", "fitness_level")
+
+DEFAULT_TIP = "Stay hydrated! Aim for 8 glasses of water daily for optimal wellness."
+
+TIP_REQUESTS = Counter("nutracia_daily_tip_requests_total", "Daily tip lookups by tier and result")
+TIPS_GENERATED = Counter("nutracia_daily_tips_generated_total", "Daily tip batch outcomes per profile group")
+
+TIP_PROMPT = """
+You are Nutracía, an intelligent medical-grade AI wellness companion.
+Write one practical, evidence-based wellness tip for today for someone with this profile:
+- Health Goals: {health_goals}
+- Dietary Preferences: {dietary_preferences}
+- Fitness Level: {fitness_level}
+
+Answer with the tip only: one or two sentences, at most 40 words, no greeting and no medical diagnosis.
+"""
+
+
+def tip_fingerprint(user: dict) -> str:
+    return profile_fingerprint(user, TIP_FIELDS)
+
+
+def build_tip_prompt(profile: dict) -> str:
+    return TIP_PROMPT.format(
+        health_goals=", ".join(profile.get("health_goals") or []) or "General wellness",
+        dietary_preferences=", ".join(profile.get("dietary_preferences") or []) or "None specified",
+        fitness_level=profile.get("fitness_level") or "Not specified",
+    )
+
+
+def _day(now: datetime) -> str:
+    return now.strftime("%Y-%m-%d")
+
+
+class DailyTips:
+    def __init__(
+        self,
+        db,
+        users,
+        gemini,
+        maxsize: int = 10000,
+        ttl: int = 600,
+        concurrency: int = 4,
+        claim_timeout: int = 600,
+        retention_days: int = 2,
+    ):
+        self.collection = db.daily_tips
+        self.users = users
+        self.gemini = gemini
+        # Misses are cached too, so a group the batch has not reached costs one read per ttl
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.concurrency = concurrency
+        self.claim_timeout = timedelta(seconds=claim_timeout)
+        self.retention = timedelta(days=retention_days)
+
+    async def get(self, fingerprint: str) -> str:
+        key = f"{_day(datetime.utcnow())}:{fingerprint}"
+        tip = self.local.get(key)
+        if tip is not None:
+            TIP_REQUESTS.inc(tier="memory", result="hit")
+            return tip or DEFAULT_TIP
+        TIP_REQUESTS.inc(tier="memory", result="miss")
+        doc = await self.collection.find_one({"_id": key, "status": "ready"}, {"tip": 1})
+        TIP_REQUESTS.inc(tier="mongo", result="hit" if doc else "miss")
+        tip = doc["tip"] if doc else ""
+        self.local.set(key, tip)
+        return tip or DEFAULT_TIP
+
+    async def generate(self, now: Optional[datetime] = None) -> dict:
+        """Write today's tip for every profile group that has none yet; returns counts by outcome."""
+        now = now or datetime.utcnow()
+        day = _day(now)
+        profiles = {}
+        for group in await self.users.profile_groups(TIP_FIELDS):
+            profiles.setdefault(tip_fingerprint(group["_id"]), group["_id"])
+        existing = {
+            doc["fingerprint"]
+            async for doc in self.collection.find({"day": day}, {"fingerprint": 1})
+        }
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def one(fingerprint: str, profile: dict) -> str:
+            async with semaphore:
+                return await self._generate_one(day, fingerprint, profile)
+
+        results = await asyncio.gather(*(
+            one(fingerprint, profile) for fingerprint, profile in profiles.items() if fingerprint not in existing
+        ))
+        counts = {"groups": len(profiles), "existing": len(profiles) - len(results)}
+        for result in results:
+            counts[result] = counts.get(result, 0) + 1
+        return counts
+
+    async def _generate_one(self, day: str, fingerprint: str, profile: dict) -> str:
+        key = f"{day}:{fingerprint}"
+        now = datetime.utcnow()
+        try:
+            await self.collection.insert_one({
+                "_id": key,
+                "day": day,
+                "fingerprint": fingerprint,
+                "status": "pending",
+                "claimed_at": now,
+                "expires_at": now + self.claim_timeout,
+            })
+        except DuplicateKeyError:
+            TIPS_GENERATED.inc(result="claimed_elsewhere")
+            return "claimed_elsewhere"
+        try:
+            tip = (await self.gemini.generate(build_tip_prompt(profile))).strip()
+        except Exception:
+            logger.exception("Daily tip generation failed for %s", fingerprint)
+            await self.collection.delete_one({"_id": key, "status": "pending"})
+            TIPS_GENERATED.inc(result="failed")
+            return "failed"
+        await self.collection.update_one(
+            {"_id": key},
+            {"$set": {
+                "status": "ready",
+                "tip": tip,
+                "created_at": datetime.utcnow(),
+                "expires_at": datetime.strptime(day, "%Y-%m-%d") + self.retention,
+            }},
+        )
+        TIPS_GENERATED.inc(result="generated")
+        return "generated"
+
+    async def run(self, interval: float) -> None:
+        """Re-run the batch every ``interval`` seconds; later runs only cover new groups and new days."""
+        while True:
+            try:
+                counts = await self.generate()
+                logger.info("Daily tips batch: %s", counts)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Daily tips batch failed")
+            await asyncio.sleep(interval)
+
+
+async def main() -> None:
+    import server
+
+    await server.ensure_indexes(server.db)
+    print(await server.daily_tips.generate())
+    server.mongo.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
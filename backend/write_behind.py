@@ -0,0 +1,134 @@
+"""Write-behind buffer that batches inserts into ``insert_many`` calls.
+
+Documents are acknowledged as soon as they are buffered and written by a
+background flusher once ``max_batch`` documents are waiting or
+``flush_interval`` seconds have passed. Memory is bounded by ``max_pending``:
+when the buffer is full the caller waits for a flush instead of growing it.
+A failed batch goes back to the front of the buffer and is retried with
+backoff; ``_id``s are assigned up front so a retry of a partly written batch
+cannot create duplicates.
+"""
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Tuple
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+BUFFERED_DOCS = Gauge("nutracia_write_behind_buffered", "Documents waiting in a write-behind buffer")
+FLUSH_BATCH_SIZE = Histogram(
+    "nutracia_write_behind_batch_size", "Documents per write-behind insert_many", buckets=(1, 5, 10, 25, 50, 100, 250, 500)
+)
+FLUSH_FAILURES = Counter("nutracia_write_behind_flush_failures_total", "Write-behind batches that failed and were requeued")
+DROPPED_DOCS = Counter("nutracia_write_behind_dropped_total", "Documents dropped after exhausting write-behind retries")
+
+
+class WriteBehindBuffer:
+    def __init__(
+        self,
+        collection,
+        max_batch: int = 100,
+        flush_interval: float = 0.5,
+        max_pending: int = 10000,
+        max_retries: int = 5,
+    ):
+        self.collection = collection
+        self.name = collection.name
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        # (document, failed attempts so far)
+        self._pending: Deque[Tuple[dict, int]] = deque()
+        self._batch_ready = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the flusher and write out everything still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        while self._pending:
+            if not await self.flush():
+                await asyncio.sleep(self._retry_delay())
+
+    async def add(self, document: dict) -> None:
+        document.setdefault("_id", ObjectId())
+        while len(self._pending) >= self.max_pending:
+            # Backpressure: the caller pays for the flush rather than memory growing
+            if not await self.flush():
+                await asyncio.sleep(self._retry_delay())
+        self._pending.append((document, 0))
+        BUFFERED_DOCS.set(len(self._pending), collection=self.name)
+        if len(self._pending) >= self.max_batch:
+            self._batch_ready.set()
+
+    async def flush(self) -> bool:
+        """Write one batch; returns False if it failed and was requeued."""
+        async with self._flush_lock:
+            batch = [self._pending.popleft() for _ in range(min(self.max_batch, len(self._pending)))]
+            if not batch:
+                return True
+            try:
+                await self.collection.insert_many([doc for doc, _ in batch], ordered=False)
+            except BulkWriteError as e:
+                # Documents a previous attempt already wrote come back as duplicates
+                written_before = {
+                    err["op"]["_id"] for err in e.details.get("writeErrors", []) if err.get("code") == DUPLICATE_KEY
+                }
+                failed = {err["op"]["_id"] for err in e.details.get("writeErrors", [])} - written_before
+                self._requeue([(doc, tries) for doc, tries in batch if doc["_id"] in failed])
+                return not failed
+            except asyncio.CancelledError:
+                # Put the batch back untouched so stop() can still write it
+                self._pending.extendleft(reversed(batch))
+                raise
+            except Exception:
+                logger.exception("Write-behind flush to %s failed", self.name)
+                self._requeue(batch)
+                return False
+            else:
+                FLUSH_BATCH_SIZE.observe(len(batch), collection=self.name)
+                return True
+            finally:
+                BUFFERED_DOCS.set(len(self._pending), collection=self.name)
+
+    def _requeue(self, batch) -> None:
+        if not batch:
+            return
+        FLUSH_FAILURES.inc(collection=self.name)
+        for doc, tries in reversed(batch):
+            if tries + 1 >= self.max_retries:
+                DROPPED_DOCS.inc(collection=self.name)
+                logger.error("Dropping %s document %s after %d failed writes", self.name, doc["_id"], tries + 1)
+            else:
+                self._pending.appendleft((doc, tries + 1))
+
+    def _retry_delay(self) -> float:
+        if not self._pending:
+            return 0
+        return min(self.flush_interval * (2 ** self._pending[0][1]), 30.0)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            while self._pending:
+                if not await self.flush():
+                    await asyncio.sleep(self._retry_delay())
+                    break
@@ -1,9 +1,49 @@
 import requests
+import gzip
 import json
 import sys
 import time
 import uuid
 from datetime import datetime
+from websockets.exceptions import ConnectionClosed
+from websockets.sync.client import connect as websocket_connect
+
+# Shared with benchmarks/load_test.py, which replays these scenarios concurrently
+def make_test_user():
+    return {
+        "email": f"test_user_{uuid.uuid4()}@test.com",
+        "password": "Test123!",
+        "name": "Test User",
+        "age": 30,
+        "health_goals": ["Weight Management", "Better Sleep", "Stress Reduction"]
+    }
+
+PROFILE_UPDATE = {
+    "name": "Updated Test User",
+    "fitness_level": "Intermediate",
+    "dietary_preferences": ["Vegetarian", "Low Carb"]
+}
+
+CART_ITEMS = [
+    {
+        "product_name": "Organic Protein Powder",
+        "category": "Supplements",
+        "price": 29.99,
+        "quantity": 1
+    },
+    {
+        "product_name": "Vitamin D3 Supplements",
+        "category": "Vitamins",
+        "price": 15.99,
+        "quantity": 2
+    }
+]
+
+WELLNESS_QUESTIONS = [
+    "I'm a 25-year-old who works from home and feels tired all day. What breakfast would you recommend?",
+    "I have combination skin and live in a dry climate. What's a good skincare routine?",
+    "I only have 15 minutes in the morning for exercise. What should I do?"
+]
 
 class NutraciaAPITester:
     def __init__(self, base_url="http://localhost:8001"):
@@ -12,13 +52,8 @@ class NutraciaAPITester:
         self.user_id = None
         self.tests_run = 0
         self.tests_passed = 0
-        self.test_user = {
-            "email": f"test_user_{uuid.uuid4()}@test.com",
-            "password": "Test123!",
-            "name": "Test User",
-            "age": 30,
-            "health_goals": ["Weight Management", "Better Sleep", "Stress Reduction"]
-        }
+        self.test_user = make_test_user()
+        self.last_response = None
 
     def run_test(self, name, method, endpoint, expected_status, data=None, headers=None):
         """Run a single API test"""
@@ -42,10 +77,13 @@ class NutraciaAPITester:
                 response = requests.post(url, json=data, headers=headers)
             elif method == 'PUT':
                 response = requests.put(url, json=data, headers=headers)
+            elif method == 'PATCH':
+                response = requests.patch(url, json=data, headers=headers)
             else:
                 print(f"❌ Unsupported method: {method}")
                 return False, None
 
+            self.last_response = response
             success = response.status_code == expected_status
             
             if success:
@@ -67,6 +105,16 @@ class NutraciaAPITester:
             print(f"❌ Failed - Error: {str(e)}")
             return False, None
 
+    def check(self, name, condition, detail=None):
+        """Count a check on a response body as a test of its own"""
+        self.tests_run += 1
+        if condition:
+            self.tests_passed += 1
+            print(f"✅ {name}")
+        else:
+            print(f"❌ {name}" + (f" - {detail}" if detail else ""))
+        return condition
+
     def test_root_endpoint(self):
         """Test the root endpoint"""
         return self.run_test(
@@ -135,11 +183,7 @@ class NutraciaAPITester:
             print("❌ Cannot test profile update - No user ID")
             return False, None
             
-        profile_data = {
-            "name": "Updated Test User",
-            "fitness_level": "Intermediate",
-            "dietary_preferences": ["Vegetarian", "Low Carb"]
-        }
+        profile_data = PROFILE_UPDATE
             
         return self.run_test(
             "Update User Profile",
@@ -202,20 +246,7 @@ class NutraciaAPITester:
             
         cart_data = {
             "user_id": self.user_id,
-            "items": [
-                {
-                    "product_name": "Organic Protein Powder",
-                    "category": "Supplements",
-                    "price": 29.99,
-                    "quantity": 1
-                },
-                {
-                    "product_name": "Vitamin D3 Supplements",
-                    "category": "Vitamins",
-                    "price": 15.99,
-                    "quantity": 2
-                }
-            ]
+            "items": CART_ITEMS
         }
             
         return self.run_test(
@@ -227,6 +258,515 @@ class NutraciaAPITester:
             headers={'Authorization': f'Bearer {self.token}'}
         )
 
+    def test_cart_patch(self):
+        """Test delta cart updates: versioning, remove and set_quantity"""
+        if not self.user_id:
+            print("❌ Cannot test cart patch - No user ID")
+            return False
+        
+        headers = {'Authorization': f'Bearer {self.token}'}
+        success, cart = self.run_test("Get Cart", "GET", f"api/cart/{self.user_id}", 200, headers=headers)
+        if not success:
+            return False
+        version = cart["version"]
+        item = {"product_name": "Magnesium Glycinate", "category": "Supplements", "price": 18.5, "quantity": 1}
+        
+        success, response = self.run_test(
+            "Patch Cart: add",
+            "PATCH",
+            f"api/cart/{self.user_id}",
+            200,
+            data={"version": version, "op": "add", "item": item},
+            headers=headers
+        )
+        if not success:
+            return False
+        self.check("Cart version advanced", response["version"] == version + 1, response)
+        
+        # The version read before the add is stale now
+        self.run_test(
+            "Patch Cart with stale version",
+            "PATCH",
+            f"api/cart/{self.user_id}",
+            409,
+            data={"version": version, "op": "add", "item": item},
+            headers=headers
+        )
+        version += 1
+        
+        # Lowering a quantity goes through set_quantity, never a negative add
+        self.run_test(
+            "Patch Cart: add with negative quantity",
+            "PATCH",
+            f"api/cart/{self.user_id}",
+            400,
+            data={"version": version, "op": "add", "item": {**item, "quantity": -5}},
+            headers=headers
+        )
+        
+        success, response = self.run_test(
+            "Patch Cart: set_quantity",
+            "PATCH",
+            f"api/cart/{self.user_id}",
+            200,
+            data={"version": version, "op": "set_quantity", "product_name": item["product_name"], "quantity": 3},
+            headers=headers
+        )
+        if success:
+            version = response["version"]
+        _, cart = self.run_test("Get Cart after set_quantity", "GET", f"api/cart/{self.user_id}", 200, headers=headers)
+        quantities = {i["product_name"]: i["quantity"] for i in (cart or {}).get("items", [])}
+        self.check("Quantity set to 3", quantities.get(item["product_name"]) == 3, quantities)
+        
+        # A quantity of zero or less removes the item
+        success, response = self.run_test(
+            "Patch Cart: set_quantity 0",
+            "PATCH",
+            f"api/cart/{self.user_id}",
+            200,
+            data={"version": version, "op": "set_quantity", "product_name": item["product_name"], "quantity": 0},
+            headers=headers
+        )
+        if success:
+            version = response["version"]
+        _, cart = self.run_test("Get Cart after set_quantity 0", "GET", f"api/cart/{self.user_id}", 200, headers=headers)
+        names = [i["product_name"] for i in (cart or {}).get("items", [])]
+        self.check("Item removed by quantity 0", item["product_name"] not in names, names)
+        
+        self.run_test(
+            "Patch Cart: set_quantity of a missing item",
+            "PATCH",
+            f"api/cart/{self.user_id}",
+            404,
+            data={"version": version, "op": "set_quantity", "product_name": item["product_name"], "quantity": 2},
+            headers=headers
+        )
+        
+        remove_name = CART_ITEMS[0]["product_name"]
+        success, response = self.run_test(
+            "Patch Cart: remove",
+            "PATCH",
+            f"api/cart/{self.user_id}",
+            200,
+            data={"version": version, "op": "remove", "product_name": remove_name},
+            headers=headers
+        )
+        _, cart = self.run_test("Get Cart after remove", "GET", f"api/cart/{self.user_id}", 200, headers=headers)
+        names = [i["product_name"] for i in (cart or {}).get("items", [])]
+        self.check("Item removed", remove_name not in names, names)
+        return success
+
+    def stream_chat(self, message, accept=None):
+        """POST to the streaming chat route; returns the open response, or None if the request failed"""
+        headers = {'Authorization': f'Bearer {self.token}'}
+        if accept:
+            headers['Accept'] = accept
+        try:
+            return requests.post(
+                f"{self.base_url}/api/chat/ai/stream",
+                json={"message": message, "user_id": self.user_id},
+                headers=headers,
+                stream=True,
+                timeout=60
+            )
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            return None
+
+    def test_chat_stream(self, sse_message="What makes a good post-workout snack?", text_message="How can I fall asleep faster?"):
+        """Test the streamed AI chat as server-sent events and as plain text"""
+        if not self.user_id:
+            print("❌ Cannot test AI streaming - No user ID")
+            return False
+        
+        print("\n🔍 Testing Stream AI Chat (server-sent events)...")
+        response = self.stream_chat(sse_message, accept="text/event-stream")
+        if not self.check("SSE stream opened", response is not None and response.status_code == 200,
+                          response is not None and response.status_code):
+            return False
+        self.check("SSE content type", response.headers.get("content-type", "").startswith("text/event-stream"),
+                   response.headers.get("content-type"))
+        events, event, data = [], None, None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+            elif not line and event:
+                events.append((event, data))
+                event, data = None, None
+        kinds = [kind for kind, _ in events]
+        self.check(
+            "SSE sends chunks then done",
+            len(kinds) >= 2 and set(kinds[:-1]) == {"chunk"} and kinds[-1] == "done",
+            kinds
+        )
+        sse_answer = "".join(data["text"] for kind, data in events if kind == "chunk")
+        
+        print("\n🔍 Testing Stream AI Chat (plain text)...")
+        response = self.stream_chat(text_message)
+        if not self.check("Text stream opened", response is not None and response.status_code == 200,
+                          response is not None and response.status_code):
+            return False
+        self.check("Text content type", response.headers.get("content-type", "").startswith("text/plain"),
+                   response.headers.get("content-type"))
+        text_answer = "".join(response.iter_content(chunk_size=None, decode_unicode=True))
+        self.check("Text stream holds a complete answer", bool(text_answer) and "[nutracia:error]" not in text_answer,
+                   text_answer[-200:])
+        
+        # Both streamed answers are recorded once they finish
+        success, history = self.run_test(
+            "Chat History after streaming",
+            "GET",
+            f"api/chat/history/{self.user_id}?limit=2&full=true",
+            200,
+            headers={'Authorization': f'Bearer {self.token}'}
+        )
+        if not success:
+            return False
+        recorded = {item["user_message"]: item["ai_response"] for item in history["items"]}
+        return self.check(
+            "Streamed answers are in the chat history",
+            recorded.get(sse_message) == sse_answer and recorded.get(text_message) == text_answer,
+            list(recorded)
+        )
+
+    @staticmethod
+    def next_frame(websocket):
+        """The next JSON frame other than a server ping"""
+        while True:
+            frame = json.loads(websocket.recv(timeout=60))
+            if frame.get("type") != "ping":
+                return frame
+
+    @staticmethod
+    def close_code(websocket):
+        """Wait for the server to close the socket; returns its close code"""
+        try:
+            while True:
+                websocket.recv(timeout=30)
+        except ConnectionClosed as e:
+            return e.rcvd.code if e.rcvd else None
+
+    def test_websocket(self, message="What should I drink during a long run?"):
+        """Test WebSocket chat: first-frame auth, streamed answers, bad frames and logout"""
+        if not self.user_id:
+            print("❌ Cannot test WebSocket chat - No user ID")
+            return False
+        
+        url = "ws" + self.base_url[len("http"):] + "/api/chat/ws"
+        print("\n🔍 Testing WebSocket Chat...")
+        try:
+            with websocket_connect(url) as websocket:
+                websocket.send(json.dumps({"type": "auth", "token": "not-a-token"}))
+                code = self.close_code(websocket)
+                self.check("Bad token closes with 4401", code == 4401, code)
+            
+            with websocket_connect(url) as websocket:
+                websocket.send(json.dumps({"type": "auth", "token": self.token}))
+                ready = self.next_frame(websocket)
+                self.check("Auth frame opens the session", ready.get("type") == "ready" and ready.get("user_id") == self.user_id, ready)
+                
+                websocket.send(json.dumps({"type": "chat", "message": message, "id": "ws-1"}))
+                frames = [self.next_frame(websocket)]
+                while frames[-1].get("type") == "chunk":
+                    frames.append(self.next_frame(websocket))
+                kinds = [frame.get("type") for frame in frames]
+                self.check(
+                    "Chat streams chunks then done",
+                    len(frames) >= 2 and kinds[-1] == "done" and all(frame.get("id") == "ws-1" for frame in frames),
+                    frames[-1]
+                )
+                
+                # A binary frame is answered with an error and the session carries on
+                websocket.send(b"\x00\x01")
+                error = self.next_frame(websocket)
+                self.check("Binary frame gets an error", error.get("type") == "error", error)
+                websocket.send(json.dumps({"type": "ping"}))
+                pong = self.next_frame(websocket)
+                self.check("Session survives a binary frame", pong.get("type") == "pong", pong)
+            
+            token = self.login_token()
+            if not token:
+                return False
+            with websocket_connect(url) as websocket:
+                websocket.send(json.dumps({"type": "auth", "token": token}))
+                self.next_frame(websocket)
+                self.run_test("Logout", "POST", "api/logout", 200, headers={'Authorization': f'Bearer {token}'})
+                # The next frame from the client finds the token revoked
+                websocket.send(json.dumps({"type": "ping"}))
+                code = self.close_code(websocket)
+                return self.check("Logged-out token closes the socket", code == 4401, code)
+        except Exception as e:
+            return self.check("WebSocket chat", False, f"Error: {str(e)}")
+
+    def test_chat_history(self):
+        """Test cursor-paginated chat history and single-message reads"""
+        if not self.user_id:
+            print("❌ Cannot test chat history - No user ID")
+            return False
+        
+        headers = {'Authorization': f'Bearer {self.token}'}
+        success, first_page = self.run_test(
+            "Chat History: first page",
+            "GET",
+            f"api/chat/history/{self.user_id}?limit=2",
+            200,
+            headers=headers
+        )
+        if not success:
+            return False
+        items = first_page["items"]
+        self.check("First page holds 2 chats", len(items) == 2, len(items))
+        self.check("First page has a next cursor", first_page["next_cursor"] is not None)
+        self.check("Listing carries previews", all("truncated" in item for item in items))
+        
+        success, second_page = self.run_test(
+            "Chat History: second page",
+            "GET",
+            f"api/chat/history/{self.user_id}?limit=2&cursor={first_page['next_cursor']}",
+            200,
+            headers=headers
+        )
+        if success:
+            first_ids = {item["id"] for item in items}
+            second_ids = {item["id"] for item in second_page["items"]}
+            self.check("Pages do not overlap", second_ids and not (first_ids & second_ids), second_ids)
+            newest_second = max((item["timestamp"] for item in second_page["items"]), default="")
+            self.check("Second page is older", newest_second <= min(item["timestamp"] for item in items))
+        
+        self.run_test(
+            "Chat History with an invalid cursor",
+            "GET",
+            f"api/chat/history/{self.user_id}?cursor=not-a-cursor",
+            400,
+            headers=headers
+        )
+        
+        success, chat = self.run_test(
+            "Chat History: single message",
+            "GET",
+            f"api/chat/history/{self.user_id}/{items[0]['id']}",
+            200,
+            headers=headers
+        )
+        if success:
+            self.check(
+                "Single message has the full answer",
+                chat["id"] == items[0]["id"] and chat["ai_response"].startswith(items[0]["ai_response"])
+            )
+        
+        return self.run_test(
+            "Chat History: unknown message",
+            "GET",
+            f"api/chat/history/{self.user_id}/000000000000000000000000",
+            404,
+            headers=headers
+        )[0]
+
+    def test_chat_job(self, message="How much protein do I need after a workout?"):
+        """Test the queued AI chat: submit, then long-poll for the answer"""
+        if not self.user_id:
+            print("❌ Cannot test AI jobs - No user ID")
+            return False, None
+        
+        headers = {'Authorization': f'Bearer {self.token}'}
+        self.run_test(
+            "Submit AI Job for another user",
+            "POST",
+            "api/chat/jobs",
+            403,
+            data={"message": message, "user_id": str(uuid.uuid4())},
+            headers=headers
+        )
+        success, job = self.run_test(
+            "Submit AI Job",
+            "POST",
+            "api/chat/jobs",
+            202,
+            data={"message": message, "user_id": self.user_id},
+            headers=headers
+        )
+        if not success:
+            return False, None
+        
+        success, result = self.run_test(
+            "Wait for AI Job",
+            "GET",
+            f"api/chat/jobs/{job['job_id']}?wait=30",
+            200,
+            headers=headers
+        )
+        if success:
+            self.check(
+                "AI Job finished with an answer",
+                result.get("status") == "done" and bool((result.get("result") or {}).get("response")),
+                result.get("status")
+            )
+        
+        self.run_test(
+            "Get unknown AI Job",
+            "GET",
+            f"api/chat/jobs/{uuid.uuid4()}",
+            404,
+            headers=headers
+        )
+        return success, result
+
+    def test_conditional_get(self):
+        """Test ETags: a repeat poll is answered 304 until the data changes"""
+        if not self.user_id:
+            print("❌ Cannot test conditional GETs - No user ID")
+            return False
+        
+        headers = {'Authorization': f'Bearer {self.token}'}
+        etags = {}
+        for name in ("profile", "dashboard", "cart"):
+            success, _ = self.run_test(f"Get {name} for its ETag", "GET", f"api/{name}/{self.user_id}", 200, headers=headers)
+            etag = self.last_response.headers.get("ETag") if success else None
+            if not self.check(f"{name} carries an ETag", bool(etag)):
+                continue
+            etags[name] = etag
+            self.run_test(
+                f"Get {name} with a matching If-None-Match",
+                "GET",
+                f"api/{name}/{self.user_id}",
+                304,
+                headers={**headers, 'If-None-Match': etag}
+            )
+        
+        # Any change to the cart moves both the cart's and the dashboard's ETag
+        self.test_cart_sync()
+        for name in ("cart", "dashboard"):
+            if name in etags:
+                self.run_test(
+                    f"Get {name} with a stale If-None-Match",
+                    "GET",
+                    f"api/{name}/{self.user_id}",
+                    200,
+                    headers={**headers, 'If-None-Match': etags[name]}
+                )
+        if "profile" in etags:
+            self.run_test(
+                "Update profile",
+                "PUT",
+                f"api/profile/{self.user_id}",
+                200,
+                data=PROFILE_UPDATE,
+                headers=headers
+            )
+            success, _ = self.run_test(
+                "Get profile with a stale If-None-Match",
+                "GET",
+                f"api/profile/{self.user_id}",
+                200,
+                headers={**headers, 'If-None-Match': etags["profile"]}
+            )
+            return success
+        return False
+
+    def test_export(self):
+        """Test the NDJSON export, gzipped and resumed with since"""
+        if not self.user_id:
+            print("❌ Cannot test export - No user ID")
+            return False
+        
+        headers = {'Authorization': f'Bearer {self.token}'}
+        success, _ = self.run_test("Export User Data", "GET", f"api/export/{self.user_id}", 200, headers=headers)
+        if not success:
+            return False
+        records = [json.loads(line) for line in self.last_response.text.splitlines()]
+        types = [record["type"] for record in records]
+        chats = [record for record in records if record["type"] == "chat"]
+        self.check(
+            "Export is export, profile, cart, chats, end",
+            types[:3] == ["export", "profile", "cart"] and types[-1] == "end" and len(chats) == len(types) - 4,
+            types
+        )
+        self.check("Export end record counts the chats", records[-1].get("chats") == len(chats), records[-1])
+        self.check(
+            "Export chats are oldest first",
+            [chat["timestamp"] for chat in chats] == sorted(chat["timestamp"] for chat in chats)
+        )
+        
+        success, _ = self.run_test("Export User Data gzipped", "GET", f"api/export/{self.user_id}?gzip=true", 200, headers=headers)
+        if success:
+            lines = gzip.decompress(self.last_response.content).decode("utf-8").splitlines()
+            self.check("Gzipped export has the same records", [json.loads(line)["type"] for line in lines] == types)
+        
+        if chats:
+            success, _ = self.run_test(
+                "Export resumed after the last chat",
+                "GET",
+                f"api/export/{self.user_id}?since={chats[-1]['timestamp']}",
+                200,
+                headers=headers
+            )
+            if success:
+                resumed = [json.loads(line) for line in self.last_response.text.splitlines()]
+                self.check("Resumed export has no chats left", resumed[-1].get("chats") == 0, resumed[-1])
+        return success
+
+    def login_token(self):
+        """A fresh token from a second login, leaving self.token alone"""
+        _, response = self.run_test(
+            "Second Login",
+            "POST",
+            "api/login",
+            200,
+            data={"email": self.test_user["email"], "password": self.test_user["password"]},
+            headers={}
+        )
+        return response['access_token'] if response else None
+
+    def test_revocation(self):
+        """Test that logged-out and revoked tokens are refused"""
+        if not self.user_id:
+            print("❌ Cannot test revocation - No user ID")
+            return False
+        
+        token = self.login_token()
+        if not token:
+            return False
+        self.run_test("Logout", "POST", "api/logout", 200, headers={'Authorization': f'Bearer {token}'})
+        self.run_test(
+            "Profile with a logged-out token",
+            "GET",
+            f"api/profile/{self.user_id}",
+            401,
+            headers={'Authorization': f'Bearer {token}'}
+        )
+        self.run_test(
+            "Profile with another session's token",
+            "GET",
+            f"api/profile/{self.user_id}",
+            200,
+            headers={'Authorization': f'Bearer {self.token}'}
+        )
+        
+        # Revoking every session also ends self.token, so log in again afterwards
+        token = self.login_token()
+        if not token:
+            return False
+        self.run_test("Revoke All Sessions", "POST", "api/sessions/revoke-all", 200, headers={'Authorization': f'Bearer {token}'})
+        self.run_test(
+            "Profile after revoking all sessions",
+            "GET",
+            f"api/profile/{self.user_id}",
+            401,
+            headers={'Authorization': f'Bearer {self.token}'}
+        )
+        success, _ = self.test_login()
+        if success:
+            success, _ = self.run_test(
+                "Profile with a token issued after revocation",
+                "GET",
+                f"api/profile/{self.user_id}",
+                200,
+                headers={'Authorization': f'Bearer {self.token}'}
+            )
+        return success
+
     def run_all_tests(self):
         """Run all API tests"""
         print("🚀 Starting Nutracía API Tests - Final Validation")
@@ -309,6 +849,10 @@ class NutraciaAPITester:
         }
         self.test_cart_sync()
         
+        # Delta updates against the synced cart
+        print("\n🧮 Patching the cart item by item:")
+        self.test_cart_patch()
+        
         # Get personalized dashboard data
         print("\n📊 Getting personalized dashboard data:")
         dashboard_success, dashboard_data = self.test_get_dashboard()
@@ -323,11 +867,7 @@ class NutraciaAPITester:
         print("\n🤖 STEP 3: Testing Full AI Conversation with Multiple Questions")
         print("-" * 70)
         
-        wellness_questions = [
-            "I'm a 25-year-old who works from home and feels tired all day. What breakfast would you recommend?",
-            "I have combination skin and live in a dry climate. What's a good skincare routine?",
-            "I only have 15 minutes in the morning for exercise. What should I do?"
-        ]
+        wellness_questions = WELLNESS_QUESTIONS
         
         ai_responses = []
         
@@ -370,6 +910,34 @@ class NutraciaAPITester:
                 # Measure response time
                 print(f"- Response time: {chat_response.get('response_time', 'N/A')} seconds")
         
+        # The same route streamed, as server-sent events and as plain text
+        print("\n📡 Streaming AI answers:")
+        self.test_chat_stream()
+        
+        # One socket, many questions
+        print("\n🔌 Chatting over a WebSocket:")
+        self.test_websocket()
+        
+        # Page through the conversation just recorded
+        print("\n📜 Paging through chat history:")
+        self.test_chat_history()
+        
+        # The same question through the queued job API
+        print("\n📨 Asking through the AI job queue:")
+        self.test_chat_job()
+        
+        # Polling with If-None-Match
+        print("\n🏷️ Revalidating with ETags:")
+        self.test_conditional_get()
+        
+        # Everything recorded above, as one NDJSON download
+        print("\n📦 Exporting user data:")
+        self.test_export()
+        
+        # Logout and revoke-all; runs last since it ends the session used above
+        print("\n🔒 Revoking sessions:")
+        self.test_revocation()
+        
         # Print overall results
         print("\n📊 Final Test Results:")
         print(f"Tests Passed: {self.tests_passed}/{self.tests_run}")
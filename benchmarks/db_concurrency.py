@@ -0,0 +1,114 @@
+"""Requests/sec of the user lookup under concurrent load, blocking vs async driver.
+
+Replays the lookup every authenticated route performs (``users.find_one({"id": ...})``)
+from many concurrent coroutines, once through the old synchronous pymongo
+client called inline from ``async def`` (how server.py used to do it) and once
+through the motor-backed ``UserRepository``.
+
+    python benchmarks/db_concurrency.py --requests 2000 --concurrency 50
+
+Runs against a local mongod unless --mongo-url is given. MONGO_URL from
+backend/.env is deliberately not used, since it points at the production
+cluster. A throwaway collection is created and dropped in the target
+database.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient
+
+from repository import UserRepository
+
+BENCH_COLLECTION = "bench_users"
+
+
+class _BenchDatabase:
+    """Points UserRepository at the throwaway collection."""
+
+    def __init__(self, db):
+        self.users = db[BENCH_COLLECTION]
+
+
+async def run_load(handler, total, concurrency):
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+
+    async def worker():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start = time.perf_counter()
+            await handler(i)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": total,
+        "seconds": round(elapsed, 3),
+        "requests_per_sec": round(total / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+    }
+
+
+async def main(args):
+    user_ids = [str(uuid.uuid4()) for _ in range(args.users)]
+
+    sync_client = MongoClient(args.mongo_url)
+    sync_collection = sync_client[args.db][BENCH_COLLECTION]
+    sync_collection.drop()
+    sync_collection.insert_many([{"id": user_id, "name": "Bench User"} for user_id in user_ids])
+    sync_collection.create_index("id", unique=True)
+
+    async_client = AsyncIOMotorClient(args.mongo_url)
+    users = UserRepository(_BenchDatabase(async_client[args.db]))
+
+    async def blocking_handler(i):
+        # What every route did before: a synchronous driver call inside async def.
+        sync_collection.find_one({"id": user_ids[i % len(user_ids)]})
+
+    async def async_handler(i):
+        await users.find_by_id(user_ids[i % len(user_ids)])
+
+    try:
+        # Warm both connection pools so neither run pays for the handshake.
+        await run_load(blocking_handler, args.concurrency, args.concurrency)
+        await run_load(async_handler, args.concurrency, args.concurrency)
+
+        before = await run_load(blocking_handler, args.requests, args.concurrency)
+        after = await run_load(async_handler, args.requests, args.concurrency)
+    finally:
+        sync_collection.drop()
+        sync_client.close()
+        async_client.close()
+
+    print(f"concurrency={args.concurrency} requests={args.requests}")
+    print(f"before (pymongo, blocking): {before}")
+    print(f"after  (motor, async):      {after}")
+    print(f"speedup: {after['requests_per_sec'] / before['requests_per_sec']:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    parser.add_argument("--db", default="nutracia_bench")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--users", type=int, default=500)
+    asyncio.run(main(parser.parse_args()))
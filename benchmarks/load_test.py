@@ -0,0 +1,342 @@
+"""Concurrent load test of the API built from backend_test.py's scenarios.
+
+Each virtual user replays NutraciaAPITester's flow -- signup, login, then
+``--iterations`` rounds of profile read, profile update, dashboard, cart sync
+and chat -- and all virtual users run at once, ``--concurrency`` at a time.
+Latency percentiles (p50/p95/p99), throughput and errors are reported per
+endpoint and can be saved as JSON to compare releases.
+
+By default the app runs in-process and fully offline: MongoDB is replaced by
+mongomock-motor (or a local mongod via --mongo-url) and Gemini by a fake
+model whose latency is set with --gemini-latency/--gemini-jitter. Pass
+--base-url to load a running server instead.
+
+mongomock-motor gets some of the app's find_one_and_update calls wrong. It
+returns None under an {"_id": 0} projection, and it applies a positional "$"
+to the wrong array element. Those code paths then skip work (cart writes,
+memory summaries) without raising, so the numbers would flatter the app.
+The in-process run probes the database for these defects first and refuses
+to run if it finds any, unless --allow-stand-in-defects is given, in which
+case the defects are reported alongside the results. Publish numbers from a
+local mongod:
+
+    pip install httpx mongomock-motor
+    python benchmarks/load_test.py --users 50 --concurrency 20 --mongo-url mongodb://localhost:27017 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BACKEND_DIR = os.path.join(ROOT_DIR, "backend")
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BACKEND_DIR)
+
+import httpx
+
+from backend_test import CART_ITEMS, PROFILE_UPDATE, WELLNESS_QUESTIONS, make_test_user
+from pymongo import ReturnDocument
+
+
+class _FakeUsage:
+    def __init__(self, prompt: str, text: str):
+        self.prompt_token_count = len(prompt) // 4 + 1
+        self.candidates_token_count = len(text) // 4 + 1
+
+
+class _FakeResponse:
+    def __init__(self, prompt: str, text: str):
+        self.text = text
+        self.usage_metadata = _FakeUsage(prompt, text)
+
+
+class _FakeStream:
+    def __init__(self, prompt: str, chunks, delay: float):
+        self._prompt = prompt
+        self._chunks = chunks
+        self._delay = delay
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self._chunks:
+            await asyncio.sleep(self._delay)
+            yield _FakeResponse(self._prompt, chunk)
+
+
+def fake_model_class(latency: float, jitter: float):
+    """A stand-in for ``genai.GenerativeModel`` that answers after ``latency`` +/- ``jitter`` seconds."""
+
+    class FakeGenerativeModel:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def _delay(self) -> float:
+            return max(0.0, latency + random.uniform(-jitter, jitter))
+
+        def _answer(self, prompt: str) -> str:
+            question = prompt.strip().splitlines()[-1]
+            return f"Evidence-based guidance for: {question} " + "Stay hydrated and eat protein. " * 20
+
+        async def generate_content_async(self, prompt, stream=False, **kwargs):
+            text = self._answer(prompt)
+            if stream:
+                words = text.split(" ")
+                chunks = [" ".join(words[i:i + 20]) + " " for i in range(0, len(words), 20)]
+                return _FakeStream(prompt, chunks, self._delay() / len(chunks))
+            await asyncio.sleep(self._delay())
+            return _FakeResponse(prompt, text)
+
+        def generate_content(self, prompt, **kwargs):
+            time.sleep(self._delay())
+            return _FakeResponse(prompt, self._answer(prompt))
+
+    return FakeGenerativeModel
+
+
+def load_app(args):
+    """Import server with its driver and model classes swapped for offline stand-ins."""
+    os.environ["MONGO_URL"] = args.mongo_url or "mongodb://localhost:27017"
+    os.environ.setdefault("JWT_SECRET_KEY", "load-test-secret")
+    os.environ.setdefault("JWT_ALGORITHM", "HS256")
+    os.environ.setdefault("GEMINI_API_KEY", "load-test")
+    # mongomock cannot explain queries
+    os.environ["VERIFY_QUERY_PLANS"] = "0"
+    # Every virtual user shares one client IP; measure the app, not the limiter
+    for name in ("RATE_LIMIT_CHAT_USER", "RATE_LIMIT_CHAT_IP", "RATE_LIMIT_AUTH_IP"):
+        os.environ.setdefault(name, "")
+    os.environ.setdefault("AI_DAILY_QUOTA", "0")
+
+    import google.generativeai as genai
+
+    genai.GenerativeModel = fake_model_class(args.gemini_latency, args.gemini_jitter)
+    genai.configure = lambda **kwargs: None
+
+    if not args.mongo_url:
+        import motor.motor_asyncio
+        from mongomock_motor import AsyncMongoMockClient
+
+        motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+
+    # load_dotenv() in server does not override the variables set above
+    import server
+
+    return server
+
+
+async def probe_stand_in_defects(db) -> list:
+    """find_one_and_update behaviours the app relies on that this database gets wrong."""
+    probe = db.load_test_probe
+
+    async def increment_b(probe_id: int, projection: dict):
+        # Shaped like CartRepository's conditional writes: filtered on owner, version and item
+        await probe.insert_one({"probe": probe_id, "version": 0, "items": [{"name": "a", "qty": 1}, {"name": "b", "qty": 1}]})
+        doc = await probe.find_one_and_update(
+            {"probe": probe_id, "version": 0, "items.name": "b"},
+            {"$inc": {"items.$.qty": 1, "version": 1}},
+            projection=projection,
+            return_document=ReturnDocument.AFTER,
+        )
+        stored = await probe.find_one({"probe": probe_id})
+        return doc, [item["qty"] for item in stored["items"]]
+
+    defects = []
+    try:
+        doc, _ = await increment_b(1, {"_id": 0, "version": 1})
+        if doc is None:
+            defects.append('find_one_and_update returns None under an {"_id": 0} projection')
+        _, quantities = await increment_b(2, {"version": 1})
+        if quantities != [1, 2]:
+            defects.append('find_one_and_update applies a positional "$" to the wrong array element')
+    finally:
+        await probe.drop()
+    return defects
+
+
+class LoadTester:
+    def __init__(self, client: httpx.AsyncClient, max_retries: int = 3):
+        self.client = client
+        self.max_retries = max_retries
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.throttled = defaultdict(int)
+
+    async def call(self, name, method, endpoint, expected_status=200, data=None, token=None):
+        """One logical request; 429/503 answers are retried after Retry-After like a well-behaved client."""
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        started = time.perf_counter()
+        try:
+            for attempt in range(self.max_retries + 1):
+                response = await self.client.request(method, f"/{endpoint}", json=data, headers=headers)
+                if response.status_code not in (429, 503) or attempt == self.max_retries:
+                    break
+                self.throttled[name] += 1
+                await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+        except httpx.HTTPError:
+            self.errors[name] += 1
+            return None
+        finally:
+            # Includes time spent backing off: that is what the client experiences
+            self.latencies[name].append(time.perf_counter() - started)
+        if response.status_code != expected_status:
+            self.errors[name] += 1
+            return None
+        return response.json()
+
+    async def virtual_user(self, iterations: int):
+        """NutraciaAPITester.run_all_tests, minus the printing."""
+        test_user = make_test_user()
+        signup = await self.call("signup", "POST", "api/signup", data=test_user)
+        if not signup:
+            return
+        login = await self.call(
+            "login", "POST", "api/login", data={"email": test_user["email"], "password": test_user["password"]}
+        )
+        session = login or signup
+        token, user_id = session["access_token"], session["user_id"]
+
+        for i in range(iterations):
+            await self.call("get_profile", "GET", f"api/profile/{user_id}", token=token)
+            await self.call("update_profile", "PUT", f"api/profile/{user_id}", data=PROFILE_UPDATE, token=token)
+            await self.call("dashboard", "GET", f"api/dashboard/{user_id}", token=token)
+            await self.call(
+                "cart_sync", "POST", "api/cart/sync", data={"user_id": user_id, "items": CART_ITEMS}, token=token
+            )
+            question = WELLNESS_QUESTIONS[i % len(WELLNESS_QUESTIONS)]
+            await self.call("chat", "POST", "api/chat/ai", data={"user_id": user_id, "message": question}, token=token)
+
+
+def percentile(sorted_values, pct: float) -> float:
+    # Nearest-rank
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(tester: LoadTester, elapsed: float) -> dict:
+    endpoints = {}
+    for name, values in tester.latencies.items():
+        values = sorted(values)
+        endpoints[name] = {
+            "requests": len(values),
+            "errors": tester.errors.get(name, 0),
+            "throttled": tester.throttled.get(name, 0),
+            "throughput_rps": round(len(values) / elapsed, 2),
+            "mean_ms": round(sum(values) / len(values) * 1000, 2),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p95_ms": round(percentile(values, 95) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+            "max_ms": round(values[-1] * 1000, 2),
+        }
+    total = sum(e["requests"] for e in endpoints.values())
+    return {
+        "elapsed_seconds": round(elapsed, 3),
+        "total_requests": total,
+        "total_errors": sum(e["errors"] for e in endpoints.values()),
+        "total_throttled": sum(e["throttled"] for e in endpoints.values()),
+        "throughput_rps": round(total / elapsed, 2),
+        "endpoints": endpoints,
+    }
+
+
+def print_report(results: dict) -> None:
+    header = f"{'endpoint':<16}{'reqs':>7}{'errs':>6}{'429/503':>9}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, e in results["endpoints"].items():
+        print(
+            f"{name:<16}{e['requests']:>7}{e['errors']:>6}{e['throttled']:>9}{e['throughput_rps']:>9}"
+            f"{e['p50_ms']:>10}{e['p95_ms']:>10}{e['p99_ms']:>10}"
+        )
+    print(
+        f"\n{results['total_requests']} requests, {results['total_errors']} errors, "
+        f"{results['total_throttled']} throttled retries "
+        f"in {results['elapsed_seconds']}s ({results['throughput_rps']} req/s)"
+    )
+    for defect in results.get("stand_in_defects", []):
+        print(f"Not representative: the database stand-in {defect}")
+
+
+async def run(args) -> dict:
+    if args.base_url:
+        transport, base_url, server, defects = None, args.base_url, None, []
+    else:
+        server = load_app(args)
+        transport, base_url = httpx.ASGITransport(app=server.app), "http://load-test"
+        defects = await probe_stand_in_defects(server.mongo.database)
+        if defects:
+            message = "The database stand-in " + "; ".join(defects) + ", so some writes would be skipped or misapplied without an error."
+            if not args.allow_stand_in_defects:
+                server.mongo.close()
+                raise SystemExit(f"{message}\nRun against a local mongod with --mongo-url, or pass --allow-stand-in-defects.")
+            print(f"WARNING: {message}\n")
+        # ASGITransport does not send lifespan events
+        await server.startup()
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout, limits=limits) as client:
+            tester = LoadTester(client, args.max_retries)
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def bounded_user():
+                async with semaphore:
+                    await tester.virtual_user(args.iterations)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(bounded_user() for _ in range(args.users)))
+            elapsed = time.perf_counter() - started
+    finally:
+        if server is not None:
+            await server.shutdown()
+
+    results = summarize(tester, elapsed)
+    if defects:
+        results["stand_in_defects"] = defects
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50, help="virtual users, each running the full scenario")
+    parser.add_argument("--concurrency", type=int, default=20, help="virtual users running at once")
+    parser.add_argument("--iterations", type=int, default=3, help="rounds of the post-login steps per user")
+    parser.add_argument("--gemini-latency", type=float, default=0.5, help="fake Gemini latency in seconds")
+    parser.add_argument("--gemini-jitter", type=float, default=0.1, help="uniform +/- jitter on the fake latency")
+    parser.add_argument("--mongo-url", help="use this MongoDB instead of the in-memory stand-in")
+    parser.add_argument("--base-url", help="load a running server instead of the in-process app")
+    parser.add_argument(
+        "--allow-stand-in-defects",
+        action="store_true",
+        help="run on mongomock-motor even though it mishandles some writes; the defects are reported with the results",
+    )
+    parser.add_argument("--max-retries", type=int, default=3, help="retries of a 429/503 answer after Retry-After")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--output", help="write results as JSON to this path")
+    args = parser.parse_args()
+
+    started_at = datetime.utcnow().isoformat()
+    results = asyncio.run(run(args))
+    print_report(results)
+    if args.output:
+        report = {
+            "started_at": started_at,
+            "python": platform.python_version(),
+            "config": {k: v for k, v in vars(args).items() if k != "output"},
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
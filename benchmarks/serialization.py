@@ -0,0 +1,128 @@
+"""Encode time and bytes on the wire for the chat and chat-history payloads.
+
+Compares the previous path (FastAPI's ``jsonable_encoder`` plus stdlib json,
+as JSONResponse renders it) against ``NegotiatedResponse``'s orjson and
+msgpack encoders, each raw and gzipped at the level the server uses.
+
+    python benchmarks/serialization.py --history-items 50 --output serialization.json
+"""
+import argparse
+import gzip
+import json
+import os
+import platform
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+from fastapi.encoders import jsonable_encoder
+
+import serialization
+
+ANSWER = (
+    "Based on your goals of weight management and better sleep, start the day with a protein-rich "
+    "breakfast such as Greek yogurt with berries and oats. Research shows that 20-30 g of protein in the "
+    "morning supports satiety and steadier energy. Stay hydrated, limit caffeine after 2 pm, and aim for "
+    "7-9 hours of sleep. "
+) * 6
+
+
+def chat_payload() -> dict:
+    return {"message": "AI response generated", "response": ANSWER, "timestamp": datetime.utcnow()}
+
+
+def history_payload(items: int, full: bool) -> dict:
+    now = datetime.utcnow()
+    answer = ANSWER if full else ANSWER[:200]
+    return {
+        "items": [
+            {
+                "id": f"{i:024x}",
+                "user_message": "What should I eat for breakfast to boost energy?",
+                "ai_response": answer,
+                "timestamp": now - timedelta(minutes=i),
+                **({} if full else {"truncated": True}),
+            }
+            for i in range(items)
+        ],
+        "next_cursor": "MjAyNi0xMC0xN1QwMjoyNDoyMy43MjgwMDB8NmFkMmRjNDg1NTczYTI3YzJkZDU3MDE5",
+    }
+
+
+def stdlib_json(content) -> bytes:
+    # What starlette's JSONResponse did after FastAPI ran jsonable_encoder
+    return json.dumps(
+        jsonable_encoder(content), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def encoders():
+    found = {
+        "jsonable_encoder+json": stdlib_json,
+        "orjson": lambda content: serialization.orjson.dumps(
+            content, default=serialization._orjson_default, option=serialization.orjson.OPT_NON_STR_KEYS
+        ),
+    }
+    if serialization.msgpack is not None:
+        found["msgpack"] = lambda content: serialization.msgpack.packb(
+            content, default=serialization._msgpack_default, use_bin_type=True
+        )
+    return found
+
+
+def measure(encode, content, number: int, gzip_level: int) -> dict:
+    body = encode(content)
+    seconds = min(timeit.repeat(lambda: encode(content), number=number, repeat=5)) / number
+    return {
+        "encode_us": round(seconds * 1e6, 2),
+        "bytes": len(body),
+        "gzip_bytes": len(gzip.compress(body, compresslevel=gzip_level)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--history-items", type=int, default=50)
+    parser.add_argument("--number", type=int, default=500, help="encodes per timing run")
+    parser.add_argument("--gzip-level", type=int, default=int(os.getenv("GZIP_LEVEL", "6")))
+    parser.add_argument("--output", help="write results as JSON to this path")
+    args = parser.parse_args()
+
+    payloads = {
+        "chat": chat_payload(),
+        "history_preview": history_payload(args.history_items, full=False),
+        "history_full": history_payload(args.history_items, full=True),
+    }
+    results = {
+        name: {encoder: measure(fn, content, args.number, args.gzip_level) for encoder, fn in encoders().items()}
+        for name, content in payloads.items()
+    }
+
+    header = f"{'payload':<17}{'encoder':<23}{'encode us':>11}{'bytes':>9}{'gzip bytes':>12}"
+    print(header)
+    print("-" * len(header))
+    for name, by_encoder in results.items():
+        baseline = by_encoder["jsonable_encoder+json"]["encode_us"]
+        for encoder, r in by_encoder.items():
+            speedup = f"  {baseline / r['encode_us']:.1f}x" if encoder != "jsonable_encoder+json" else ""
+            print(f"{name:<17}{encoder:<23}{r['encode_us']:>11}{r['bytes']:>9}{r['gzip_bytes']:>12}{speedup}")
+    if serialization.msgpack is None:
+        print("\nmsgpack is not installed; skipped")
+
+    if args.output:
+        report = {
+            "created_at": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "config": {k: v for k, v in vars(args).items() if k != "output"},
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()